@@ -0,0 +1,77 @@
+import time, threading, queue
+
+# Collects inference requests coming from several worker threads and runs them through
+# the model in one forward pass. Each worker calls Submit() with one preprocessed input
+# and blocks until the output for that input is available.
+#
+# A batch is started by the first request that arrives, and is closed when it's full or
+# when max_wait seconds have passed since then, whichever comes first. This way, a lone
+# request (for example the last image of a directory) is delayed by max_wait at most.
+
+class _BatchSlot:
+    __slots__=('input','output','error','done')
+    def __init__(self,x):
+        self.input=x
+        self.output=None
+        self.error=None
+        self.done=threading.Event()
+
+class InferenceBatcher:
+    def __init__(self,forward,batch_size:int,max_wait:float):
+        # forward: list of inputs -> list of outputs, same length and order
+        self._forward=forward
+        self._batch_size=batch_size
+        self._max_wait=max_wait
+        self._q=queue.Queue()
+        self._lck=threading.Lock()
+        self.nBatches:int=0
+        self.nItems:int=0
+        self._thread=threading.Thread(target=self._batcher_thread,daemon=True)
+        self._thread.start()
+
+    def Submit(self,x):
+        slot=_BatchSlot(x)
+        self._q.put(slot)
+        slot.done.wait()
+        if slot.error is not None: raise slot.error
+        return slot.output
+
+    def Stop(self):
+        self._q.put(None)
+        self._thread.join()
+
+    def Report(self)->str:
+        with self._lck:
+            avg=self.nItems/self.nBatches if self.nBatches>0 else 0
+            return f"inference batches: {self.nBatches}, images: {self.nItems}, average batch size: {avg:.2f}"
+
+    def _batcher_thread(self):
+        while True:
+            slot=self._q.get()
+            if slot is None: break
+            batch=[slot]
+            deadline=time.monotonic()+self._max_wait
+            stopping=False
+            while len(batch)<self._batch_size:
+                remaining=deadline-time.monotonic()
+                if remaining<=0: break
+                try:
+                    slot=self._q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if slot is None:
+                    stopping=True
+                    break
+                batch.append(slot)
+
+            try:
+                outputs=self._forward([s.input for s in batch])
+                for s,y in zip(batch,outputs): s.output=y
+            except Exception as e:
+                for s in batch: s.error=e
+            finally:
+                for s in batch: s.done.set()
+            with self._lck:
+                self.nBatches=self.nBatches+1
+                self.nItems=self.nItems+len(batch)
+            if stopping: break
@@ -0,0 +1,113 @@
+import os, threading, hashlib
+from PIL import Image
+
+# On-disk cache of foreground masks, for the -mc option. A mask only depends on the image's
+# pixels, the model and the options that change masks, not on what the output is made of
+# (-mu, -bc, -bi), so rerunning a job with another background gets all its masks from here.
+#
+# The key of a mask is a SHA-256 over the decoded pixels, image size and mode, the model's
+# name and a hash of its files, and the mask options. Masks are saved as 8-bit grayscale PNG
+# files named after their key, in 256 subdirectories. Every hit touches the file, so the files
+# that weren't used for the longest time have the oldest mtime. When the cache grows over its
+# size limit, those are deleted first, until it's down to 80% of the limit.
+
+# options that change masks
+MASK_OPTIONS=['model','invert_mask','face_scale','face_tracking','engine','precision','optimize',
+               'channels_last','inference_size','fit','refine_tile']
+
+def _HashFile(fn:str,h):
+    with open(fn,'rb') as f:
+        while True:
+            b=f.read(1<<20)
+            if not b: break
+            h.update(b)
+
+class MaskCache:
+    def __init__(self,theCtx:dict,cache_dir:str,max_mb:float,model_files:list[str]):
+        self._dir=cache_dir
+        self._maxBytes=int(max_mb*1048576)
+        self._lck=threading.Lock()
+        self.nHits:int=0
+        self.nMisses:int=0
+
+        # everything but the pixels, hashed once
+        h=hashlib.sha256()
+        for fn in model_files:
+            if os.path.isfile(fn): _HashFile(fn,h)
+        for k in MASK_OPTIONS: h.update(f"{k}={theCtx.get(k)};".encode())
+        self._prefix=h.digest()
+
+        os.makedirs(cache_dir,exist_ok=True)
+        self._bytes=sum(sz for sz,mtime,path in self._ListFiles())
+
+    def _ListFiles(self) -> list[tuple]:
+        # (size,mtime,path) of every cached mask
+        files=[]
+        for sub in os.scandir(self._dir):
+            if not sub.is_dir(): continue
+            for e in os.scandir(sub.path):
+                try:
+                    if e.is_file() and e.name.endswith(".png"):
+                        st=e.stat()
+                        files.append((st.st_size,st.st_mtime,e.path))
+                except OSError: # deleted by another process
+                    pass
+        return files
+
+    def _Path(self,i1:Image,pixels) -> str:
+        h=hashlib.sha256(self._prefix)
+        h.update(f"{i1.size};{i1.mode};".encode())
+        # PIL can't hand out its pixels without a copy, a frame buffer from stdin can
+        h.update(pixels.data if pixels is not None else i1.tobytes())
+        key=h.hexdigest()
+        return os.path.join(self._dir,key[:2],key[2:]+".png")
+
+    def GetMask(self,getMask,theCtx:dict,i1:Image,pixels=None) -> Image:
+        # getMask: the function that makes the mask if it's not in the cache
+        path=self._Path(i1,pixels)
+        try:
+            with Image.open(path) as mask:
+                mask.load()
+            os.utime(path) # most recently used
+            with self._lck: self.nHits=self.nHits+1
+            return mask
+        except (OSError,ValueError): # not there, or unreadable, which is as good as not there
+            pass
+
+        mask=getMask(theCtx,i1,pixels)
+        with self._lck: self.nMisses=self.nMisses+1
+        self._Put(path,mask)
+        return mask
+
+    def _Put(self,path:str,mask:Image):
+        tmp=f"{path}.{os.getpid()}.{threading.get_native_id()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            mask.save(tmp,format="PNG",compress_level=6)
+            size=os.stat(tmp).st_size
+            os.replace(tmp,path) # nobody ever sees a partial file
+        except OSError as e:
+            print(f"mask cache: could not save {path}, {e}")
+            return
+        with self._lck:
+            self._bytes=self._bytes+size
+            if self._bytes>self._maxBytes: self._Evict()
+
+    def _Evict(self):
+        # called with the lock held
+        files=self._ListFiles()
+        files.sort(key=lambda x: x[1])
+        total=sum(x[0] for x in files)
+        target=self._maxBytes*0.8
+        for size,mtime,path in files:
+            if total<=target: break
+            try:
+                os.remove(path)
+                total=total-size
+            except OSError:
+                pass
+        self._bytes=total
+
+    def Report(self) -> str:
+        with self._lck:
+            return f"mask cache: {self.nHits} hits, {self.nMisses} misses, {self._bytes/1048576:.1f} MB"
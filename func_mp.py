@@ -1,4 +1,4 @@
-import os, sys, threading
+import os, sys, threading, queue
 import mediapipe as mp
 from mediapipe.tasks import python
 from mediapipe.tasks.python import vision
@@ -7,56 +7,78 @@ import numpy as np
 import cv2
 from PIL import Image, ImageDraw, ImageFilter, ImageOps
 
-def GetFaceMask(theCtx:dict,img:Image) -> Image:
+def GetFaceMask(theCtx:dict,img:Image,pixels=None) -> Image:
+    # pixels: optional numpy HxWx3 RGB uint8 array with the same content as img
     maskImg=Image.new('L',size=img.size,color=0)
 
-    haar=theCtx['haar_cascade']
-    #haar=GetHaarCascade()
-    cv_img = np.array(img.convert("L"))
-    with theCtx['cascade_classifier_lock']:
+    # in video mode, the tracker may give us where the faces were in the last frame
+    tracker:FaceTracker=theCtx.get('face_tracker')
+    crops=tracker.GetRegions() if tracker is not None else None
+    tracking=crops is not None
+    if not tracking:
+        haar=_GetThreadHaarCascade(theCtx)
+        if pixels is not None: cv_img = cv2.cvtColor(pixels,cv2.COLOR_RGB2GRAY)
+        else: cv_img = np.array(img.convert("L"))
         faces_rect = haar.detectMultiScale(cv_img, scaleFactor=1.1, minNeighbors=3,minSize=(64,64))
 
-    landmarker=theCtx['mp_face_landmarker']
+        # candidate face areas, the same face is often found more than once
+        crops=[]
+        for x, y, w, h in _DedupFaceRects(faces_rect): #open cv Rect coordinates are [inclusive,exclusive)
+            crops.append(_FaceRectToCrop(x,y,w,h))
+            #print(f"haar cascade found face: {crops[-1]}")
+    foundRects=[] # where faces were actually found, for the tracker
+
+    pool:LandmarkerPool=theCtx['mp_face_landmarkers']
     vidx = theCtx['mp_face_oval']
     nFound:int=0
     face_scale=theCtx['face_scale']
-    for x, y, w, h in faces_rect: #open cv Rect coordinates are [inclusive,exclusive)
-        x0,x1=int(x-w/3), int(x+w+w/3)
-        y0,y1=int(y-h/2), int(y+h+h/3)
-        #print(f"haar cascade found face: {x0},{y0} {x1},{y1}")
-        imgcrop=img.crop((x0,y0,x1,y1))
-        #imgcrop.save(f"c:\\temp\\found{nFound}.png")
-        image=mp.Image(image_format=mp.ImageFormat.SRGB, data=np.asarray(imgcrop.convert('RGB')))
-        detection_result = landmarker.detect(image)
-        if 0==len(detection_result.face_landmarks): continue
+    if len(crops)>0:
+        # convert image to RGB once, and run all its crops with one landmarker
+        if pixels is not None: rgb=pixels
+        else: rgb=np.asarray(img if img.mode=="RGB" else img.convert("RGB"))
+        landmarker=pool.Acquire() # waits if all landmarkers are in use by other threads
+    try:
+        for x0,y0,x1,y1 in crops:
+            cropW,cropH=x1-x0,y1-y0
+            image=mp.Image(image_format=mp.ImageFormat.SRGB, data=_CropRGB(theCtx,rgb,x0,y0,x1,y1))
+            detection_result = landmarker.detect(image)
+            if 0==len(detection_result.face_landmarks): continue
         
-        #print("mediapipe found face")
-        nFound=nFound+1
-        facelandmark=detection_result.face_landmarks[0]
-        face_landmarks_proto = landmark_pb2.NormalizedLandmarkList()
-        face_landmarks_proto.landmark.extend([
-            landmark_pb2.NormalizedLandmark(x=landmark.x, y=landmark.y, z=landmark.z) for landmark in facelandmark
-        ])
-        vertices=[]
-        sumx:float=0
-        sumy:float=0
-        for i in vidx:
-            if (0<=i<len(face_landmarks_proto.landmark)):
-                x,y= face_landmarks_proto.landmark[i].x,face_landmarks_proto.landmark[i].y
-                sumx=sumx+x
-                sumy=sumy+y
-                vertices.append([x,y])
-        ctrx=sumx/len(vertices)
-        ctry=sumy/len(vertices)
-        #print("center:",ctrx,ctry)
-        #print(vertices)
-        v2=[]
-        for xy in vertices:
-            x2=ctrx+(xy[0]-ctrx)*face_scale
-            y2=ctry+(xy[1]-ctry)*face_scale
-            v2.append( ( round(imgcrop.size[0]*x2)+x0, round(imgcrop.size[1]*y2)+y0 ) )
-        ImageDraw.Draw(maskImg).polygon(v2,fill=255,outline=255)
-        #ImageDraw.Draw(img).polygon(v2,fill=None,outline=255) #testing cx
+            #print("mediapipe found face")
+            nFound=nFound+1
+            facelandmark=detection_result.face_landmarks[0]
+            if tracker is not None:
+                lx=[lm.x for lm in facelandmark]
+                ly=[lm.y for lm in facelandmark]
+                foundRects.append((x0+cropW*min(lx),y0+cropH*min(ly),
+                                   cropW*(max(lx)-min(lx)),cropH*(max(ly)-min(ly))))
+            face_landmarks_proto = landmark_pb2.NormalizedLandmarkList()
+            face_landmarks_proto.landmark.extend([
+                landmark_pb2.NormalizedLandmark(x=landmark.x, y=landmark.y, z=landmark.z) for landmark in facelandmark
+            ])
+            vertices=[]
+            sumx:float=0
+            sumy:float=0
+            for i in vidx:
+                if (0<=i<len(face_landmarks_proto.landmark)):
+                    x,y= face_landmarks_proto.landmark[i].x,face_landmarks_proto.landmark[i].y
+                    sumx=sumx+x
+                    sumy=sumy+y
+                    vertices.append([x,y])
+            ctrx=sumx/len(vertices)
+            ctry=sumy/len(vertices)
+            #print("center:",ctrx,ctry)
+            #print(vertices)
+            v2=[]
+            for xy in vertices:
+                x2=ctrx+(xy[0]-ctrx)*face_scale
+                y2=ctry+(xy[1]-ctry)*face_scale
+                v2.append( ( round(cropW*x2)+x0, round(cropH*y2)+y0 ) )
+            ImageDraw.Draw(maskImg).polygon(v2,fill=255,outline=255)
+            #ImageDraw.Draw(img).polygon(v2,fill=None,outline=255) #testing cx
+    finally:
+        if len(crops)>0: pool.Release(landmarker)
+    if tracker is not None: tracker.Update(foundRects,tracking and nFound<len(crops))
 
     if 0==nFound:
         print("warning: no face detected",file=sys.stderr)
@@ -66,13 +88,92 @@ def GetFaceMask(theCtx:dict,img:Image) -> Image:
     if theCtx['invert_mask']: fImg=ImageOps.invert(fImg)
     return fImg
     
+def _FaceRectToCrop(x,y,w,h) -> tuple:
+    # area given to the landmarker for a face found at (x,y,w,h), with room around it
+    x0,x1=int(x-w/3), int(x+w+w/3)
+    y0,y1=int(y-h/2), int(y+h+h/3)
+    return (x0,y0,x1,y1)
+
+class FaceTracker:
+    # For video frames: instead of running the Haar cascade on every frame, faces are looked
+    # for where the landmarker found them in the last frame. Full detection runs again every
+    # nth frame, when no face is being tracked, and when the landmarker loses a tracked face.
+    # Frames from several threads can be in progress at once, so "last frame" is the last one
+    # that finished, which is close enough for faces that don't jump around.
+    def __init__(self,n:int):
+        self._n=n
+        self._lck=threading.Lock()
+        self._rects=None  # faces (x,y,w,h) of the last frame, None to detect again
+        self._age:int=0   # frames since last full detection
+        self.nDetections:int=0
+        self.nTracked:int=0
+
+    def GetRegions(self) -> list:
+        # returns crop areas to look for faces in, or None if full detection is needed
+        with self._lck:
+            if self._rects is None or self._age>=self._n:
+                self._age=0
+                self.nDetections=self.nDetections+1
+                return None
+            self._age=self._age+1
+            self.nTracked=self.nTracked+1
+            return [_FaceRectToCrop(*r) for r in self._rects]
+
+    def Update(self,foundRects:list,lostFace:bool):
+        with self._lck:
+            if lostFace or len(foundRects)==0: self._rects=None
+            else: self._rects=foundRects
+
+    def Report(self) -> str:
+        with self._lck:
+            return f"face tracking: {self.nDetections} full detections, {self.nTracked} tracked frames"
+
+def _DedupFaceRects(faces_rect,maxOverlap:float=0.6) -> list:
+    # Haar cascade often reports one face several times, with slightly different rectangles.
+    # Going from the largest rectangle down, a rectangle is skipped if more than maxOverlap
+    # of its area is covered by a rectangle already kept.
+    rects=sorted([tuple(int(v) for v in r) for r in faces_rect],key=lambda r: r[2]*r[3],reverse=True)
+    kept=[]
+    for x,y,w,h in rects:
+        dup=False
+        for kx,ky,kw,kh in kept:
+            iw=min(x+w,kx+kw)-max(x,kx)
+            ih=min(y+h,ky+kh)-max(y,ky)
+            if iw>0 and ih>0 and iw*ih>maxOverlap*w*h:
+                dup=True
+                break
+        if not dup: kept.append((x,y,w,h))
+    return kept
+
+def _CropRGB(theCtx:dict,rgb:np.ndarray,x0:int,y0:int,x1:int,y1:int) -> np.ndarray:
+    # Returns area [x0,x1) x [y0,y1) of rgb, areas outside of rgb are black, like PIL's crop().
+    # Crops are copied into a buffer that each thread reuses, since MediaPipe wants contiguous
+    # data, and copies it into its own image anyway.
+    tl=theCtx['face_crop_buffers']
+    n=(y1-y0)*(x1-x0)*3
+    buf=getattr(tl,'buf',None)
+    if buf is None or buf.size<n:
+        buf=np.empty(n,dtype=np.uint8)
+        tl.buf=buf
+    crop=buf[:n].reshape(y1-y0,x1-x0,3)
+    h,w=rgb.shape[0],rgb.shape[1]
+    sx0,sy0,sx1,sy1=max(x0,0),max(y0,0),min(x1,w),min(y1,h)
+    if sx0>x0 or sy0>y0 or sx1<x1 or sy1<y1: crop.fill(0)
+    if sx1>sx0 and sy1>sy0:
+        crop[sy0-y0:sy1-y0,sx0-x0:sx1-x0]=rgb[sy0:sy1,sx0:sx1]
+    return crop
+
 def GetFaceMask2(theCtx:dict,img:Image) -> Image:
     maskImg=Image.new('L',size=img.size,color=0)
     # makes no assumption about outline
     vidx = frozenset( [i for v in mp.solutions.face_mesh.FACEMESH_FACE_OVAL for i in v] )
     image=mp.Image(image_format=mp.ImageFormat.SRGB, data=np.asarray(img.convert('RGB')))
-    detector=theCtx['mp_face_landmarker']
-    detection_result = detector.detect(image)
+    pool:LandmarkerPool=theCtx['mp_face_landmarkers']
+    detector=pool.Acquire()
+    try:
+        detection_result = detector.detect(image)
+    finally:
+        pool.Release(detector)
     #print(detection_result)
     if 0==len(detection_result.face_landmarks):
         print("warning: no face detected",file=sys.stderr)
@@ -108,20 +209,56 @@ def GetFaceMask2(theCtx:dict,img:Image) -> Image:
     if theCtx['invert_mask']: fImg=ImageOps.invert(fImg)
     return fImg
 
-def GetMediaPipeLandmarker():
-    current_dir = os.path.dirname(__file__)
-    full_model_path=os.path.join(current_dir,"pretrained_models","face_landmarker_v2_with_blendshapes.task")
+# model files, the face mask depends on both
+LANDMARKER_FILE=os.path.join(os.path.dirname(__file__),"pretrained_models","face_landmarker_v2_with_blendshapes.task")
+HAAR_CASCADE_FILE=os.path.join(os.path.dirname(__file__),"pretrained_models","haarcascade_frontalface_alt2.xml")
+
+def GetMediaPipeLandmarker(blendshapes:bool=False,transformation_matrixes:bool=False):
+    # blendshapes and transformation matrixes aren't used for face masks, so by default
+    # they're not computed
+    full_model_path=LANDMARKER_FILE
     if not os.path.isfile(full_model_path):
         print(f"model file doesn't exist: {full_model_path}",file=sys.stderr)
         return None
 
     base_options = python.BaseOptions(model_asset_path=full_model_path)
     options = vision.FaceLandmarkerOptions(base_options=base_options,
-                    output_face_blendshapes=True, output_facial_transformation_matrixes=True,
+                    output_face_blendshapes=blendshapes, output_facial_transformation_matrixes=transformation_matrixes,
                     num_faces=1)
     detector = vision.FaceLandmarker.create_from_options(options)
     return detector
 
+class LandmarkerPool:
+    # MediaPipe makes no promise that a FaceLandmarker can be used by several threads at
+    # once, so every thread checks out its own instance with Acquire(), and gives it back
+    # with Release(). Up to maxSize instances are created as they're needed, after that,
+    # Acquire() waits for an instance to be released.
+    def __init__(self,maxSize:int,first=None):
+        self._q=queue.Queue()
+        self._lck=threading.Lock()
+        self._maxSize=maxSize
+        self._nCreated:int=0
+        if first is not None:
+            self._q.put(first)
+            self._nCreated=1
+
+    def Acquire(self):
+        try:
+            return self._q.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lck:
+            create=self._nCreated<self._maxSize
+            if create: self._nCreated=self._nCreated+1
+        if create:
+            lm=GetMediaPipeLandmarker()
+            if lm is not None: return lm
+            with self._lck: self._nCreated=self._nCreated-1
+        return self._q.get()
+
+    def Release(self,landmarker):
+        self._q.put(landmarker)
+
 def GetMediaPipeFaceOval():
     d={}
     for xy in mp.solutions.face_mesh.FACEMESH_FACE_OVAL:
@@ -138,8 +275,7 @@ def GetMediaPipeFaceOval():
     return v
         
 def GetHaarCascade():
-    current_dir = os.path.dirname(__file__)
-    full_model_path=os.path.join(current_dir,"pretrained_models","haarcascade_frontalface_alt2.xml")
+    full_model_path=HAAR_CASCADE_FILE
     if not os.path.isfile(full_model_path):
         print(f"model file doesn't exist: {full_model_path}",file=sys.stderr)
         return None
@@ -147,18 +283,36 @@ def GetHaarCascade():
     haar_cascade = cv2.CascadeClassifier(full_model_path)
     return haar_cascade
 
+def _GetThreadHaarCascade(theCtx:dict):
+    # OpenCV's cascade classifier is not multithread-safe, so every thread gets its own,
+    # created the first time the thread needs one
+    tl=theCtx['haar_cascades']
+    haar=getattr(tl,'classifier',None)
+    if haar is None:
+        haar=GetHaarCascade()
+        tl.classifier=haar
+    return haar
+
+def _SetOpenCVThreads(theCtx:dict):
+    # OpenCV's classifier may be internally multi-threaded, by default with one thread per core.
+    # With several workers each running their own classifier, that's too many threads, so the
+    # -cvt option can set the number of threads OpenCV uses, 0 means cores divided by workers.
+    n=theCtx.get('cv_threads')
+    if n is None: return
+    if n==0:
+        nWorkers=theCtx['threads'] if theCtx.get('pipeline') is None else theCtx['pipeline'][1]
+        n=max(1,(os.cpu_count() or 1)//nWorkers)
+    cv2.setNumThreads(n)
+
 def InitMediaPipe(theCtx:dict)->int:
+    _SetOpenCVThreads(theCtx)
     print(f"openCV thread count:",cv2.getNumThreads())
 
     fd=GetHaarCascade()
     if fd is None: return -1
-    theCtx['haar_cascade']=fd
-
-    ### OpenCV's cascade classifier is not multithread-safe, but may be internally multi-threaded.
-    ### By default, openCV uses one thread per core, so using its classifier with a mutex is an
-    ### OK approach. To get max performance, we should create a classifier for each
-    ### thread, and tune the number of threads we use and openCV uses.
-    theCtx['cascade_classifier_lock']=threading.Lock()
+    theCtx['haar_cascades']=threading.local()
+    theCtx['haar_cascades'].classifier=fd # the calling thread can use this one
+    theCtx['face_crop_buffers']=threading.local()
 
     fd=GetMediaPipeFaceOval()
     if fd is None: return -2
@@ -166,5 +320,7 @@ def InitMediaPipe(theCtx:dict)->int:
     
     fd=GetMediaPipeLandmarker()
     if fd is None: return -3
-    theCtx['mp_face_landmarker']=fd
+    # one landmarker for each worker that can be detecting faces at the same time
+    nWorkers=theCtx['threads'] if theCtx.get('pipeline') is None else theCtx['pipeline'][1]
+    theCtx['mp_face_landmarkers']=LandmarkerPool(nWorkers,fd)
     return 0
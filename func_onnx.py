@@ -0,0 +1,120 @@
+import os, sys
+import numpy as np
+from PIL import Image
+import onnxruntime as ort
+
+from func_batch import InferenceBatcher
+from func_resolution import InferenceGeometry
+
+# The u2net models run by ONNX Runtime on CPU, for "-engine onnxruntime". Pre- and
+# postprocessing are done with numpy and PIL, the same steps as in func_u2net, so torch isn't
+# imported at all once the ONNX file exists. It's exported from the .pth weights the first
+# time, which does need torch and onnx, and saved next to them in pretrained_models, for
+# example u2netp.pth -> u2netp.onnx. An existing ONNX file is always used as is, whatever its
+# date, so it can be copied around with the weights; delete it to export it again.
+
+# weights file of each model, same as in func_u2net, which can't be imported without torch
+_WEIGHTS={'u2net':"u2net.pth", 'u2netp':"u2netp.pth", 'u2neths':"u2net_human_seg.pth"}
+
+_NORM_MEAN=np.array((0.485, 0.456, 0.406),dtype=np.float32)
+_NORM_STD=np.array((0.229, 0.224, 0.225),dtype=np.float32)
+
+def _GetWeightsFile(model_name:str) -> str:
+    return os.path.join(os.path.dirname(__file__),"pretrained_models",_WEIGHTS[model_name])
+
+def GetONNXFile(model_name:str) -> str:
+    return os.path.splitext(_GetWeightsFile(model_name))[0]+".onnx"
+
+def _ExportONNX(model_name:str,onnx_file:str) -> bool:
+    print(f"exporting {model_name} to {onnx_file} ...")
+    tmp=f"{onnx_file}.{os.getpid()}.tmp" # other processes may be loading it
+    try:
+        import torch, func_u2net
+        net=func_u2net.GetU2NetModel(model_name)
+        if net is None: return False
+        net.cpu()
+        with torch.inference_mode():
+            torch.onnx.export(net,torch.zeros((1,3,320,320)),tmp,input_names=["input"],output_names=["mask"],
+                              dynamic_axes={"input":{0:"batch",2:"height",3:"width"},"mask":{0:"batch",1:"height",2:"width"}},
+                              opset_version=17,dynamo=False)
+        os.replace(tmp,onnx_file)
+    except Exception as e: # torch or onnx not installed, or the export itself failed
+        print(f"could not export {model_name} to ONNX, {type(e)}: {e}",file=sys.stderr)
+        if os.path.exists(tmp): os.remove(tmp)
+        return False
+    return True
+
+def GetU2NetSession(model_name:str,intra_threads:int=0,inter_threads:int=0) -> ort.InferenceSession:
+    # thread counts of 0 let ONNX Runtime decide. Returns None if the model can't be loaded.
+    if model_name not in _WEIGHTS:
+        print(f"unexpected model name: {model_name}")
+        return None
+    weights=_GetWeightsFile(model_name)
+    onnx_file=GetONNXFile(model_name)
+    if os.path.isfile(weights) and not os.path.isfile(onnx_file):
+        if not _ExportONNX(model_name,onnx_file): return None
+    if not os.path.isfile(onnx_file):
+        print(f"model file doesn't exist: {onnx_file}",file=sys.stderr)
+        return None
+
+    opts=ort.SessionOptions()
+    opts.intra_op_num_threads=intra_threads
+    opts.inter_op_num_threads=inter_threads
+    opts.graph_optimization_level=ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    mb=int(os.stat(onnx_file).st_size/1048576+0.5)
+    print(f"loading {onnx_file}, {mb} MB, ONNX Runtime CPU mode ...")
+    return ort.InferenceSession(onnx_file,opts,providers=["CPUExecutionProvider"])
+
+def _PreprocessImage(i1:Image,pixels,geometry) -> np.ndarray:
+    # 3xSxS float32, same as func_u2net._PreprocessImage. PIL's bilinear resize is
+    # antialiased like torchvision's. pixels isn't used, PIL needs the image anyway.
+    s,cw,ch=geometry
+    image=np.asarray(i1.resize((cw,ch),Image.BILINEAR),dtype=np.float32)
+    if image.ndim==2: image=image[:,:,None]
+    image=image/max(float(image.max()),1e-6)
+    if image.shape[2]==1:
+        image=(image-_NORM_MEAN[0])/_NORM_STD[0]
+        image=np.repeat(image,3,axis=2)
+    else:
+        image=(image-_NORM_MEAN)/_NORM_STD
+    if (cw,ch)!=(s,s): image=np.pad(image,((0,s-ch),(0,s-cw),(0,0))) # zeros, the mean color
+    return np.ascontiguousarray(image.transpose(2,0,1),dtype=np.float32)
+
+def RunU2Net(session:ort.InferenceSession,images:list[np.ndarray]) -> list[np.ndarray]:
+    # run a list of preprocessed images through the net in one call, returns a
+    # list of SxS outputs in the same order
+    if any(x.shape!=images[0].shape for x in images): # with -rs 0, sizes can differ
+        return [RunU2Net(session,[x])[0] for x in images]
+    d1=session.run(None,{"input":np.stack(images)})[0]
+    return [d1[i] for i in range(d1.shape[0])]
+
+def _PostprocessMask(theCtx:dict,d1:np.ndarray,size,geometry,norm:dict=None) -> Image:
+    # norm: see func_u2net.GetForegroundMask
+    s,cw,ch=geometry
+    d1=d1[:ch,:cw] # without padding
+    if norm is not None and 'range' in norm:
+        mi,ma=norm['range']
+        if ma>mi: d1=np.clip((d1-mi)/(ma-mi),0,1)
+    else:
+        ma=d1.max()
+        mi=d1.min()
+        if (ma!=mi):
+            d1=(d1-mi)/(ma-mi)
+        if norm is not None: norm['range']=(float(mi),float(ma))
+    if theCtx['invert_mask']: d1=1-d1
+    im=Image.fromarray((d1*255).astype(np.uint8),"L") # truncated, like ToPILImage
+    return im.resize(size,resample=Image.LANCZOS)
+
+def GetU2NetBatcher(session:ort.InferenceSession,batch_size:int,max_wait:float) -> InferenceBatcher:
+    return InferenceBatcher(lambda images: RunU2Net(session,images),batch_size,max_wait)
+
+def GetForegroundMask(theCtx:dict,i1:Image,pixels=None,norm:dict=None) -> Image:
+    # norm: see func_u2net.GetForegroundMask
+    geometry=InferenceGeometry(theCtx,i1.size)
+    image=_PreprocessImage(i1,pixels,geometry)
+    batcher:InferenceBatcher=theCtx.get('u2net_batcher')
+    if batcher is None:
+        d1=RunU2Net(theCtx['u2net_onnx'],[image])[0]
+    else: # wait for the batcher to run this image together with images from other threads
+        d1=batcher.Submit(image)
+    return _PostprocessMask(theCtx,d1,i1.size,geometry,norm)
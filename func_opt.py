@@ -0,0 +1,73 @@
+import os, time, warnings
+import torch
+import torch.nn as nn
+
+import func_u2net
+from u2net_engine import fuse_conv_bn
+
+# Optimized builds of the float u2net models, for the -opt option:
+#   fuse    : BatchNorm folded into the conv weights of every REBNCONV, still eager mode
+#   jit     : fused, then traced with TorchScript and frozen, so weights become constants and
+#             conv+ReLU pairs, casts and the like are fused into the graph. The frozen graph
+#             is saved in pretrained_models/cache and loaded from there by later runs.
+#   compile : fused, then compiled with torch.compile. Compiled kernels are cached by torch
+#             in pretrained_models/cache/inductor (see func_u2net), so later runs compile
+#             much faster.
+# Graphs are traced with a 320x320 input, but the traced and frozen graph takes any input size,
+# so it also works with -rs and -fit. torch.compile specializes on input size: with -rs 0 or
+# -fit pad, new sizes make it compile again (depending on torch's dynamic shape settings,
+# once for a size-generic graph or once per size), which takes as long as the first compile.
+
+def _ExampleInput(channels_last:bool) -> torch.Tensor:
+    x=torch.zeros((1,3,320,320),device=func_u2net._device)
+    return x.contiguous(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+
+def _Autocast(precision:str,device:torch.device):
+    dtype=func_u2net._PRECISIONS[precision]
+    return torch.autocast(device_type=device.type,dtype=dtype,enabled=dtype is not None)
+
+def _Trace(net:nn.Module,precision:str,channels_last:bool,cache_file:str) -> torch.jit.ScriptModule:
+    print("tracing and freezing the net ...")
+    t0=time.perf_counter()
+    if channels_last: net.to(memory_format=torch.channels_last)
+    x=_ExampleInput(channels_last)
+    with warnings.catch_warnings(), torch.inference_mode(), _Autocast(precision,x.device):
+        warnings.simplefilter("ignore") # torch.jit deprecation warnings
+        traced=torch.jit.freeze(torch.jit.trace(net,x).eval())
+        os.makedirs(func_u2net.CACHE_DIR,exist_ok=True)
+        tmp=f"{cache_file}.{os.getpid()}.tmp" # other processes may be loading the cache
+        torch.jit.save(traced,tmp)
+    os.replace(tmp,cache_file)
+    print(f"traced in {time.perf_counter()-t0:.1f} s, saved to {cache_file}")
+    return traced
+
+def _Compile(net:nn.Module,precision:str,channels_last:bool) -> nn.Module:
+    if channels_last: net.to(memory_format=torch.channels_last)
+    compiled=torch.compile(net)
+    print("compiling the net ...")
+    t0=time.perf_counter()
+    x=_ExampleInput(channels_last)
+    with torch.inference_mode(), _Autocast(precision,x.device):
+        compiled(x) # compile now, not in the first worker thread that uses it
+    print(f"compiled in {time.perf_counter()-t0:.1f} s")
+    return compiled
+
+def OptimizeU2NetModel(model_name:str,opt:str,precision:str,channels_last:bool) -> nn.Module:
+    # returns the model built as opt says, None if it can't be loaded
+    cache_file=None
+    if opt=='jit' and os.path.isfile(func_u2net.GetU2NetModelFile(model_name)):
+        device=func_u2net._device
+        cache_file=func_u2net.GetCacheFile(model_name,f"jit_{device.type}_{precision}{'_cl' if channels_last else ''}")
+        if os.path.isfile(cache_file):
+            mb=os.stat(cache_file).st_size/1048576
+            print(f"loading {cache_file}, {mb:.1f} MB ...")
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                return torch.jit.load(cache_file,map_location=device)
+
+    net=func_u2net.GetU2NetModel(model_name)
+    if net is None or opt=='none': return net
+    fuse_conv_bn(net)
+    if opt=='jit': return _Trace(net,precision,channels_last,cache_file)
+    if opt=='compile': return _Compile(net,precision,channels_last)
+    return net
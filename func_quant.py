@@ -0,0 +1,86 @@
+import os, sys, time, warnings
+from PIL import Image
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+import func_u2net
+
+# Static int8 post-training quantization of the u2net models, for CPU only. The float model
+# is traced with torch.fx, observers are inserted after every convolution, a calibration run
+# over a folder of images records activation ranges, then convolutions, BatchNorm and ReLU are
+# replaced by fused int8 kernels. The result is frozen as TorchScript and cached in
+# pretrained_models/cache, so calibration only happens once per model and weights file.
+# Use the compare command to see how far its masks are from the float model's.
+
+_MAX_CALIBRATION_IMAGES=200
+
+# the u2net decoders concatenate features with different ranges, torch warns about it on
+# every forward pass, that's expected and already reflected in the compare results
+warnings.filterwarnings("ignore",message="All inputs of this cat operator")
+
+def _LoadCalibrationImages(calibration_dir:str) -> list[torch.Tensor]:
+    # only files with an extension PIL knows are opened, the same as in dir mode
+    extensions=set(Image.registered_extensions())
+    images=[]
+    for fn in sorted(os.listdir(calibration_dir)):
+        if len(images)>=_MAX_CALIBRATION_IMAGES: break
+        if os.path.splitext(fn)[1].lower() not in extensions: continue
+        path=os.path.join(calibration_dir,fn)
+        if not os.path.isfile(path): continue
+        try:
+            with Image.open(path) as i1:
+                i1=i1.convert("RGB")
+        except Exception as e:
+            print(f"{path}: could not load, {type(e)}: {e}")
+            continue
+        images.append(func_u2net._PreprocessImage(i1))
+    return images
+
+def _Quantize(model_name:str,calibration_dir:str,cache_file:str) -> torch.jit.ScriptModule:
+    images=_LoadCalibrationImages(calibration_dir)
+    if len(images)==0:
+        print(f"no calibration images in {calibration_dir}",file=sys.stderr)
+        return None
+    net=func_u2net.GetU2NetModel(model_name)
+    if net is None: return None
+
+    print(f"quantizing {model_name}, calibrating with {len(images)} images ...")
+    t0=time.perf_counter()
+    example=images[0][None]
+    with warnings.catch_warnings(), torch.inference_mode():
+        warnings.simplefilter("ignore") # torch.ao and torch.jit deprecation warnings
+        prepared=prepare_fx(net,get_default_qconfig_mapping('x86'),(example,))
+        for x in images: prepared(x[None])
+        qnet=convert_fx(prepared)
+        qnet=torch.jit.freeze(torch.jit.trace(qnet,example).eval())
+        os.makedirs(func_u2net.CACHE_DIR,exist_ok=True)
+        tmp=f"{cache_file}.{os.getpid()}.tmp" # other processes may be loading the cache
+        torch.jit.save(qnet,tmp)
+    os.replace(tmp,cache_file)
+    print(f"quantized in {time.perf_counter()-t0:.1f} s, saved to {cache_file}")
+    return qnet
+
+def GetQuantizedU2NetModel(model_name:str,calibration_dir:str) -> torch.jit.ScriptModule:
+    # returns the int8 model, from cache if there's one, otherwise calibrated with the
+    # images in calibration_dir. None if that can't be done.
+    if func_u2net.UsesCUDA():
+        print("int8 precision runs on CPU only, use fp16 with CUDA",file=sys.stderr)
+        return None
+    weights=func_u2net.GetU2NetModelFile(model_name)
+    if not os.path.isfile(weights):
+        print(f"model file doesn't exist: {weights}",file=sys.stderr)
+        return None
+
+    cache_file=func_u2net.GetCacheFile(model_name,"int8")
+    if os.path.isfile(cache_file):
+        mb=os.stat(cache_file).st_size/1048576
+        print(f"loading {cache_file}, {mb:.1f} MB, int8 CPU mode ...")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return torch.jit.load(cache_file,map_location='cpu')
+
+    if calibration_dir is None:
+        print(f"no quantized {model_name} model yet, use -qc to give a directory of calibration images",file=sys.stderr)
+        return None
+    return _Quantize(model_name,calibration_dir,cache_file)
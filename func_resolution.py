@@ -0,0 +1,76 @@
+import threading
+import numpy as np
+from PIL import Image
+
+# Resolution policy of the u2net models, for both engines.
+#
+# The net takes a square input. By default, every image is stretched to 320x320, and the
+# 320x320 mask is stretched back to the image's size. The -rs option sets another square
+# size, smaller for speed, or 0 to pick one from the image's size, so that a thumbnail isn't
+# scaled up to 320 pixels first. With "-fit pad", the image keeps its aspect ratio: it's
+# scaled so that its long side fills the square, and the rest of the square is padded with
+# zeros, which is the mean color after normalization. The padded part of the mask is cut off.
+#
+# For large images, -refine runs the net again on tiles of the image along the boundary of
+# the first mask, where the upscaled mask is blurry, and keeps the first mask everywhere else.
+# The engines scale each mask to its own min and max, so a tile that is all foreground or all
+# background would come out stretched over the whole range; tiles are scaled with the first
+# mask's min and max instead.
+
+DEFAULT_SIZE=320
+_AUTO_MAX_SIZE=320 # -rs 0 picks at most this
+_BAND_LOW,_BAND_HIGH=16,239 # mask values in between are boundary, to be refined
+
+def InferenceGeometry(theCtx:dict,size) -> tuple[int,int,int]:
+    # for an image of size (w,h), returns (s,cw,ch): side of the square input, and size
+    # that the image is scaled to, at the top left of the square
+    w,h=size
+    s=theCtx.get('inference_size',DEFAULT_SIZE)
+    if s==0: s=min(_AUTO_MAX_SIZE,max(32,-(-max(w,h)//32)*32)) # long side rounded up to 32
+    if theCtx.get('fit','stretch')=='stretch': return s,s,s
+    scale=s/max(w,h)
+    return s,max(1,min(s,round(w*scale))),max(1,min(s,round(h*scale)))
+
+def _Tiles(length:int,tile:int) -> list[int]:
+    # start positions of tiles covering 0..length, overlapping by a quarter of a tile
+    if length<=tile: return [0]
+    step=tile*3//4
+    starts=list(range(0,length-tile,step))
+    starts.append(length-tile)
+    return starts
+
+def RefinedMask(getMask,theCtx:dict,i1:Image,pixels=None) -> Image:
+    # getMask: the engine's GetForegroundMask. Tiles whose mask overlaps in an area are averaged.
+    norm={} # the first mask's output range, to scale the tiles with
+    mask=getMask(theCtx,i1,pixels,norm)
+    tile=theCtx['refine_tile']
+    w,h=i1.size
+    if max(w,h)<=tile: return mask # the first mask is as good as it gets
+
+    coarse=np.asarray(mask)
+    band=(coarse>=_BAND_LOW)&(coarse<=_BAND_HIGH)
+    if not band.any(): return mask
+    total=np.zeros(coarse.shape,dtype=np.float32)
+    count=np.zeros(coarse.shape,dtype=np.uint16)
+    tw,th=min(tile,w),min(tile,h)
+    nTiles=0
+    for y in _Tiles(h,th):
+        for x in _Tiles(w,tw):
+            if not band[y:y+th,x:x+tw].any(): continue
+            m=np.asarray(getMask(theCtx,i1.crop((x,y,x+tw,y+th)),None,norm),dtype=np.float32)
+            total[y:y+th,x:x+tw]+=m
+            count[y:y+th,x:x+tw]+=1
+            nTiles=nTiles+1
+    _CountTiles(theCtx,nTiles)
+
+    refined=coarse.copy()
+    sel=band&(count>0)
+    refined[sel]=np.rint(total[sel]/count[sel]).astype(np.uint8)
+    return Image.fromarray(refined,"L")
+
+_tiles_lck=threading.Lock()
+
+def _CountTiles(theCtx:dict,n:int):
+    with _tiles_lck:
+        theCtx['refine_images']=theCtx.get('refine_images',0)+1
+        theCtx['refine_tiles']=theCtx.get('refine_tiles',0)+n
@@ -0,0 +1,105 @@
+import threading
+import numpy as np
+from PIL import Image
+
+# Mask reuse for video input. Consecutive frames from a static camera are nearly the same,
+# so running the model on every one of them is mostly wasted work. Frames are read one
+# after another, and for each one KeyframeSelector compares a small grayscale thumbnail with
+# the one of the last keyframe. If the difference is below a threshold, the frame gets the
+# mask of the last keyframe instead of its own; otherwise it becomes a keyframe itself.
+#
+# Frames then go through several worker threads, so a frame can get to the model before its
+# keyframe's mask is ready. Masks are shared through MaskFuture objects: whoever asks for a
+# keyframe's mask first computes it, everybody else waits for that. Nobody ever waits for
+# work that isn't already being done, so this can't deadlock, whatever order frames arrive
+# in the model stage.
+#
+# Optionally, keyframe masks are smoothed over time, each one is blended with the one before
+# it, to reduce flicker along mask edges.
+
+_THUMBNAIL_WIDTH=80 # frame difference is computed on images about this wide
+
+class MaskFuture:
+    def __init__(self,compute,prev=None,smoothing:float=0):
+        # compute: function that returns the mask, prev: MaskFuture of the keyframe before,
+        # smoothing: weight of prev's mask in this one's, 0 for none
+        self._compute=compute
+        self._prev=prev
+        self._smoothing=smoothing
+        self._lck=threading.Lock()
+        self._started:bool=False
+        self._done=threading.Event()
+        self._mask:Image=None
+        self._error:Exception=None
+
+    def Get(self) -> Image:
+        with self._lck:
+            first=not self._started
+            self._started=True
+        if first:
+            try:
+                self._mask=self._Compute()
+            except Exception as e:
+                self._error=e
+            finally:
+                self._compute=None # let go of the frame it was computed from
+                self._prev=None
+                self._done.set()
+        else:
+            self._done.wait()
+        if self._error is not None: raise self._error
+        return self._mask
+
+    def _Compute(self) -> Image:
+        mask=self._compute()
+        if self._prev is None or self._smoothing<=0: return mask
+        try:
+            prevMask=self._prev.Get()
+        except Exception:
+            return mask # nothing to smooth with
+        if prevMask.size!=mask.size or prevMask.mode!=mask.mode: return mask
+        a=np.asarray(mask,dtype=np.float32)
+        b=np.asarray(prevMask,dtype=np.float32)
+        a=a+self._smoothing*(b-a)
+        return Image.fromarray(np.rint(a).astype(np.uint8),mask.mode)
+
+class KeyframeSelector:
+    def __init__(self,width:int,height:int,threshold:float,maxInterval:int,smoothing:float):
+        # threshold: mean absolute difference of thumbnail pixels (0..255) from the last
+        #   keyframe, below which a frame reuses its mask; 0 makes every frame a keyframe
+        # maxInterval: a keyframe is forced after this many frames in a row reused a mask
+        self._step=max(1,width//_THUMBNAIL_WIDTH)
+        self._threshold=threshold
+        self._maxInterval=maxInterval
+        self._smoothing=smoothing
+        self._keyThumb:np.ndarray=None
+        self._keyFuture:MaskFuture=None
+        self._age:int=0
+        self.nKeyframes:int=0
+        self.nReused:int=0
+
+    def _Thumbnail(self,pixels:np.ndarray) -> np.ndarray:
+        s=self._step
+        return pixels[::s,::s].sum(axis=2,dtype=np.int32)//3
+
+    def Next(self,pixels:np.ndarray,compute) -> MaskFuture:
+        # call for every frame, in order. pixels: HxWx3 frame content, compute: function
+        # that returns the frame's mask if it becomes a keyframe
+        thumb=None
+        if self._threshold>0:
+            thumb=self._Thumbnail(pixels)
+            if self._keyFuture is not None and self._age<self._maxInterval:
+                diff=np.abs(thumb-self._keyThumb).mean()
+                if diff<self._threshold:
+                    self._age=self._age+1
+                    self.nReused=self.nReused+1
+                    return self._keyFuture
+        self._keyThumb=thumb
+        prev=self._keyFuture if self._smoothing>0 else None
+        self._keyFuture=MaskFuture(compute,prev,self._smoothing)
+        self._age=0
+        self.nKeyframes=self.nKeyframes+1
+        return self._keyFuture
+
+    def Report(self) -> str:
+        return f"keyframes: {self.nKeyframes}, frames that reused a keyframe's mask: {self.nReused}"
@@ -1,31 +1,47 @@
-import os, sys, time, threading, queue
+import os, sys, time, threading, queue, hashlib
 from PIL import Image
+
+# optimized and quantized models are saved here, see func_quant and func_opt
+CACHE_DIR=os.path.join(os.path.dirname(__file__),"pretrained_models","cache")
+# kernels compiled by torch.compile (-opt compile) too. This must be set before torch is
+# imported, torchvision makes torch read it on import.
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR",os.path.join(CACHE_DIR,"inductor"))
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision import transforms
 
 # u2net is  173.6 MB full size version, u2netp is smaller version 4.7 MB
-from u2net_engine import U2NET, U2NETP 
+from u2net_engine import U2NET, U2NETP
+from func_batch import InferenceBatcher
+from func_resolution import InferenceGeometry, DEFAULT_SIZE
+
+# model name: (weights file in pretrained_models, net class)
+_MODELS={'u2net':("u2net.pth",U2NET), 'u2netp':("u2netp.pth",U2NETP), 'u2neths':("u2net_human_seg.pth",U2NET)}
+
+def GetU2NetModelFile(model_name:str) -> str:
+    current_dir = os.path.dirname(__file__)
+    return os.path.join(current_dir,"pretrained_models",_MODELS[model_name][0])
+
+def GetCacheFile(model_name:str,variant:str) -> str:
+    # file name for a model built from model_name's weights, tied to the weights file
+    # and the torch version that built it. variant must describe how it was built.
+    weights=GetU2NetModelFile(model_name)
+    st=os.stat(weights)
+    key=f"{os.path.basename(weights)}:{st.st_size}:{st.st_mtime_ns}:{torch.__version__}"
+    return os.path.join(CACHE_DIR,f"{model_name}_{variant}_{hashlib.sha256(key.encode()).hexdigest()[:16]}.pt")
 
 def GetU2NetModel(model_name:str) -> nn.Module:
     #The net object should be thread-safe and can be shared among threads.
     #If it's not, we can just create a separate instance in each thread.
 
-    if(model_name=='u2net'):
-        model_filename="u2net.pth"
-        net = U2NET(3,1)
-    elif(model_name=='u2netp'):
-        model_filename="u2netp.pth"
-        net = U2NETP(3,1)
-    elif(model_name=='u2neths'):
-        model_filename="u2net_human_seg.pth"
-        net = U2NET(3,1)
-    else:
+    if model_name not in _MODELS:
         print(f"unexpected model name: {model_name}")
         return None
+    net = _MODELS[model_name][1](3,1)
 
-    current_dir = os.path.dirname(__file__)
-    full_model_path=os.path.join(current_dir,"pretrained_models",model_filename)
+    full_model_path=GetU2NetModelFile(model_name)
     if not os.path.isfile(full_model_path):
         print(f"model file doesn't exist: {full_model_path}",file=sys.stderr)
         return None
@@ -40,42 +56,178 @@ def GetU2NetModel(model_name:str) -> nn.Module:
         print(f"loading {full_model_path}, {mb} MB, CPU mode ...")
         net.load_state_dict(torch.load(full_model_path, map_location='cpu'))
     net.eval()
+    net.requires_grad_(False)
     return net
 
-def GetForegroundMask(theCtx:dict,i1:Image) -> Image:
-    net:nn.Module=theCtx['u2net']
-    
+def UsesCUDA() -> bool:
+    return torch.cuda.is_available()
+
+# autocast data type for each -precision option, None to run in float32
+_PRECISIONS={'fp32':None, 'bf16':torch.bfloat16, 'fp16':torch.float16, 'int8':None}
+
+class InferenceRuntime:
+    # Wraps a model returned by GetU2NetModel() so that it can only be used for inference:
+    # forward passes run in inference mode, which means no autograd graph is recorded, and
+    # intermediate activations are freed as soon as the net is done with them.
+    # If report_memory is True, peak memory of each call is printed. On CUDA, it's the peak
+    # memory allocated by torch during the call. On CPU under Linux, it's the process' peak RSS
+    # during the call, the high-water mark being reset before it. Elsewhere, the high-water
+    # mark can't be reset, so it's the process' peak RSS so far. These counters are for the
+    # whole process, so calls are run one at a time while they're measured.
+    # precision: 'bf16' or 'fp16' run convolutions in that type under autocast, output is
+    # float32 either way. An int8 net (see func_quant) runs as is. channels_last: weights and inputs are stored NHWC instead of NCHW,
+    # which most CPU and GPU convolution kernels handle faster, together with bf16/fp16.
+    def __init__(self,net:nn.Module,report_memory:bool=False,precision:str='fp32',channels_last:bool=False):
+        self.net=net
+        self._report_memory=report_memory
+        self._lck=threading.Lock()
+        self._dtype=_PRECISIONS[precision]
+        self._memory_format=torch.channels_last if channels_last else torch.contiguous_format
+        if channels_last and not isinstance(net,torch.jit.ScriptModule): # traced ones already are
+            net.to(memory_format=torch.channels_last)
+
+    def _forward(self,x:torch.Tensor) -> torch.Tensor:
+        x=x.contiguous(memory_format=self._memory_format)
+        with torch.inference_mode():
+            if self._dtype is None: return self.net(x)
+            with torch.autocast(device_type=x.device.type,dtype=self._dtype):
+                y=self.net(x)
+            return y.float()
+
+    def __call__(self,x:torch.Tensor) -> torch.Tensor:
+        if not self._report_memory:
+            return self._forward(x)
+
+        with self._lck:
+            if x.is_cuda: torch.cuda.reset_peak_memory_stats(x.device)
+            else: reset=_ResetPeakRSS()
+            t0=time.perf_counter()
+            y=self._forward(x)
+            t1=time.perf_counter()
+            if x.is_cuda:
+                peak=f"peak CUDA memory {torch.cuda.max_memory_allocated(x.device)/1048576:.1f} MB"
+            elif reset:
+                peak=f"peak RSS {_GetPeakRSS()/1048576:.1f} MB"
+            else:
+                peak=f"process peak RSS so far {_GetPeakRSS()/1048576:.1f} MB"
+            print(f"thread {threading.get_native_id()}: inference batch {x.shape[0]}, {1000*(t1-t0):.1f} ms, {peak}")
+        return y
+
+def _ResetPeakRSS() -> bool:
+    # Linux only: sets the process' peak RSS (VmHWM) back to its current RSS
+    try:
+        with open("/proc/self/clear_refs","w") as f: f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _GetPeakRSS() -> int:
+    try: # VmHWM, which _ResetPeakRSS resets, ru_maxrss doesn't see that
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"): return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError: # not available on Windows
+        return 0
+    rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform=='darwin' else rss*1024 # bytes on macOS, KB on Linux
+
+# Where inputs and outputs of the net live. With CUDA, images are uploaded as 8-bit pixels,
+# everything else up to the finished 8-bit mask is done on the GPU, the CPU only converts
+# between numpy and PIL.
+_device=torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+# normalization constants the net was trained with, made once per device
+_NORM_MEAN=(0.485, 0.456, 0.406)
+_NORM_STD=(0.229, 0.224, 0.225)
+_norm_tensors:dict={}
+
+def _GetNormTensors(device:torch.device) -> tuple[torch.Tensor,torch.Tensor]:
+    t=_norm_tensors.get(device)
+    if t is None: # no lock, worst case two threads make the same tensors
+        t=(torch.tensor(_NORM_MEAN,device=device).view(3,1,1),torch.tensor(_NORM_STD,device=device).view(3,1,1))
+        _norm_tensors[device]=t
+    return t
+
+@torch.inference_mode()
+def _PreprocessImage(i1:Image,pixels=None,geometry=(DEFAULT_SIZE,DEFAULT_SIZE,DEFAULT_SIZE)) -> torch.Tensor:
+    # pixels: optional numpy HxWxC uint8 array with the same content as i1, used as is to avoid copying i1
+    # geometry: see func_resolution.InferenceGeometry
+    s,cw,ch=geometry
+    if pixels is not None: image=torch.from_numpy(pixels).permute(2,0,1)
+    else: image=transforms.PILToTensor()(i1)
+    if _device.type=='cuda':
+        # upload 8-bit pixels, a quarter of the size of float, and resize on the GPU
+        image=image.to(_device).float()
     #image=transforms.PILToTensor()(i1.resize((320,320),Image.LANCZOS)) #use PIL to resize
-    image=transforms.Resize((320,320),antialias=True)(transforms.PILToTensor()(i1)) #use torch to resize
+    image=transforms.Resize((ch,cw),antialias=True)(image) #use torch to resize
 
-    npmax=torch.max(image)
-    if (npmax>1e-6): image = image/npmax
-    else: image=image.type(torch.FloatTensor) #need to convert to float type
+    # scale to 0..1, an all black image stays all zeros
+    image=image.float()/torch.max(image).clamp(min=1e-6)
 
+    mean,std=_GetNormTensors(image.device)
     if(1==image.shape[0]):
-        tnorm = transforms.Normalize(mean=0.485, std=0.229)
-        image=tnorm(image)
+        image=(image-mean[:1])/std[:1]
         image = image.tile((3,1,1))
     else:
-        tnorm = transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))
-        image=tnorm(image)
+        image=(image-mean)/std
 
-    inputs_test = image.type(torch.FloatTensor)
-    if torch.cuda.is_available():
-        inputs_test = inputs_test.cuda()
-    else:
-        pass
+    if (cw,ch)!=(s,s): image=F.pad(image,(0,s-cw,0,s-ch)) # zeros, the mean color
+    return image
 
-    inputs_test=torch.unsqueeze(inputs_test, dim=0)
+def RunU2Net(net:InferenceRuntime,images:list[torch.Tensor]) -> list[torch.Tensor]:
+    # run a list of preprocessed 3xSxS images through the net in one forward pass,
+    # returns a list of 1xSxS outputs in the same order
+    if any(x.shape!=images[0].shape for x in images): # with -rs 0, sizes can differ
+        return [RunU2Net(net,[x])[0] for x in images]
+    inputs_test=torch.stack(images).to(_device) # already there if preprocessed on the GPU
     d1 = net(inputs_test)
+    return [d1[i:i+1] for i in range(d1.shape[0])]
 
-    ma=torch.max(d1)
-    mi=torch.min(d1)
-    #print(f"ma {ma} mi {mi}")
-    if (ma!=mi):
-        d1=(d1-mi)/(ma-mi)
+@torch.inference_mode()
+def _PostprocessMask(theCtx:dict,d1:torch.Tensor,size,geometry,norm:dict=None) -> Image:
+    # norm: see GetForegroundMask
+    s,cw,ch=geometry
+    d1=d1[:,:ch,:cw] # without padding
+    if norm is not None and 'range' in norm:
+        mi,ma=norm['range']
+        if ma>mi: d1=((d1-mi)/(ma-mi)).clamp(0,1)
+    else:
+        ma=torch.max(d1)
+        mi=torch.min(d1)
+        #print(f"ma {ma} mi {mi}")
+        d1=torch.where(ma>mi,(d1-mi)/(ma-mi),d1)
+        if norm is not None: norm['range']=(mi.item(),ma.item())
     if theCtx['invert_mask']: d1=1-d1
+
+    if d1.is_cuda:
+        # scale up to source size on the GPU, only the finished 8-bit mask comes back
+        w,h=size
+        d1=F.interpolate(d1[None],size=(h,w),mode='bicubic',align_corners=False)
+        mask=d1[0,0].clamp_(0,1).mul_(255).round_().to(torch.uint8).cpu().numpy()
+        return Image.fromarray(mask,"L")
+
     im= transforms.ToPILImage("L")(d1)
     del d1
 
-    return im.resize(i1.size,resample=Image.LANCZOS)
+    return im.resize(size,resample=Image.LANCZOS)
+
+def GetU2NetBatcher(net:InferenceRuntime,batch_size:int,max_wait:float) -> InferenceBatcher:
+    return InferenceBatcher(lambda images: RunU2Net(net,images),batch_size,max_wait)
+
+def GetForegroundMask(theCtx:dict,i1:Image,pixels=None,norm:dict=None) -> Image:
+    # The net's output is scaled so that its min and max become 0 and 255. norm: if not None
+    # and it has a 'range', the output is scaled with that (min,max) instead, otherwise the
+    # output's own (min,max) is stored there. func_resolution uses it to scale tiles of an
+    # image the same way as the whole image.
+    geometry=InferenceGeometry(theCtx,i1.size)
+    image=_PreprocessImage(i1,pixels,geometry)
+    batcher:InferenceBatcher=theCtx.get('u2net_batcher')
+    if batcher is None:
+        d1=RunU2Net(theCtx['u2net'],[image])[0]
+    else: # wait for the batcher to run this image together with images from other threads
+        d1=batcher.Submit(image)
+    return _PostprocessMask(theCtx,d1,i1.size,geometry,norm)
@@ -27,6 +27,15 @@ EPILOG = """The mask usage option (-mu, --mask-usage):
     type=click.Choice(["u2net","u2netp","u2neths","face"]),
     show_default=True, show_choices=True, help="select model: 'u2net', 'u2netp', 'u2neths', or 'face'" )
 
+@click.option("-mm","model_map",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True),
+    help="dir mode: file with lines of \"PATTERN MODEL\", input files matching a pattern use "
+    "that model instead of -model")
+
+@click.option("-mms","model_memory_mb",default=0,type=click.FloatRange(0),
+    show_default=True, help="max MB of models loaded for -mm or serve mode's ?model=, least "
+    "recently used ones are unloaded first; 0 = no limit")
+
 @click.option("-mu","mask_usage",default='0',
     type=click.Choice(['0','1','2']),
     show_default=True, show_choices=True, help="mask usage" )
@@ -37,9 +46,115 @@ EPILOG = """The mask usage option (-mu, --mask-usage):
 @click.option("-t","threads",default=1,type=click.IntRange(1),
     show_default=True, help="number of worker threads")
 
+@click.option("-backend","backend",default="thread",
+    type=click.Choice(["thread","process"]),
+    show_default=True, show_choices=True, help="run dir mode workers as threads or as processes" )
+
+@click.option("-ps","pipeline",nargs=4,type=click.IntRange(1),default=None,
+    show_default=False, help="run dir, stdin and serve modes as a pipeline of decode, infer, "
+    "composite and encode stages, each with its own number of threads; overrides -t")
+
+@click.option("-inc","incremental",default=False,
+    is_flag=True, show_default=True, help="dir mode: skip input files whose output is up to date, "
+    "as recorded in a manifest in the output directory")
+
+@click.option("-r","recursive",default=False,
+    is_flag=True, show_default=True, help="dir mode: also process subdirectories, mirroring them in the output directory")
+
+@click.option("-glob","file_patterns",multiple=True,
+    help="dir mode: process files whose name matches this pattern, for example \"*.jpg\"; "
+    "can be repeated. Default is every file with an image extension")
+
+@click.option("-sq","serve_queue",default=16,type=click.IntRange(1),
+    show_default=True, help="serve mode: max number of requests waiting for a worker, more are "
+    "turned away with 503")
+
+@click.option("-of","output_format",default="png",
+    type=click.Choice(["png","raw"]),
+    show_default=True, show_choices=True, help="stdin mode output: PNG files, or raw frames in input order" )
+
+@click.option("-ra","read_ahead",default=4,type=click.IntRange(1),
+    show_default=True, help="stdin mode: number of frames to read ahead of processing")
+
+@click.option("-bs","batch_size",default=1,type=click.IntRange(1),
+    show_default=True, help="max number of images per inference batch, useful with -t > 1")
+
+@click.option("-bw","batch_wait",default=20,type=click.FloatRange(0),
+    show_default=True, help="max milliseconds to wait for a batch to fill up")
+
+@click.option("-pm","peak_memory",default=False,
+    is_flag=True, show_default=True, help="report time and peak memory of each inference call; on CPU other than Linux, "
+    "process peak RSS so far" )
+
+@click.option("-engine","engine",default="torch",
+    type=click.Choice(['torch','onnxruntime'],case_sensitive=False),
+    show_default=True, show_choices=True, help="u2net models: run with PyTorch, or with ONNX Runtime on CPU")
+
+@click.option("-intra","intra_threads",default=0,type=click.IntRange(0),
+    show_default=True, help="-engine onnxruntime: threads used within an operator, 0 = ONNX Runtime's default")
+
+@click.option("-inter","inter_threads",default=0,type=click.IntRange(0),
+    show_default=True, help="-engine onnxruntime: threads used to run operators in parallel, 0 = ONNX Runtime's default")
+
+@click.option("-precision","precision",default="fp32",
+    type=click.Choice(['fp32','bf16','fp16','int8'],case_sensitive=False),
+    show_default=True, show_choices=True, help="u2net models: compute precision, bf16 is meant for "
+    "CPU, fp16 for CUDA, int8 is quantized for CPU; see the compare command")
+
+@click.option("-qc","calibration_dir",default=None,
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True),
+    help="with -precision int8: directory of calibration images, needed the first time a model is quantized")
+
+@click.option("-opt","optimize",default="none",
+    type=click.Choice(['none','fuse','jit','compile'],case_sensitive=False),
+    show_default=True, show_choices=True, help="u2net models: fold BatchNorm into convolutions, "
+    "and optionally freeze the net with TorchScript or compile it with torch.compile")
+
+@click.option("-cl","channels_last",default=False,
+    is_flag=True, show_default=True, help="u2net models: use channels-last memory layout" )
+
+@click.option("-rs","inference_size",default=320,type=click.IntRange(0),
+    show_default=True, help="u2net models: size of the square image the net sees, smaller is faster; "
+    "0 = image's long side rounded up to a multiple of 32, at most 320")
+
+@click.option("-fit","fit",default="stretch",type=click.Choice(['stretch','pad'],case_sensitive=False),
+    show_default=True, show_choices=True, help="u2net models: stretch images to a square for the net, "
+    "or keep their aspect ratio and pad them")
+
+@click.option("-refine","refine_tile",default=0,type=click.IntRange(0),
+    show_default=True, help="u2net models: for images larger than N pixels, run the net again on "
+    "NxN tiles along the mask's boundary; 0 = no refinement")
+
+@click.option("-mc","mask_cache_dir",default=None,
+    type=click.Path(file_okay=False, dir_okay=True, writable=True),
+    help="directory to cache masks in, so that images already seen with the same model and mask "
+    "options skip inference")
+
+@click.option("-mcs","mask_cache_mb",default=1024,type=click.FloatRange(1),
+    show_default=True, help="max size of the mask cache in MB, least recently used masks are deleted first")
+
+@click.option("-kt","keyframe_threshold",default=0,type=click.FloatRange(0),
+    show_default=True, help="stdin mode: frames that differ from the last keyframe by less than "
+    "this (mean pixel difference, 0-255) reuse its mask; 0 = run the model on every frame")
+
+@click.option("-ki","keyframe_interval",default=10,type=click.IntRange(1),
+    show_default=True, help="stdin mode, with -kt: run the model at least every N+1 frames")
+
+@click.option("-tsm","mask_smoothing",default=0,type=click.FloatRange(0,1,max_open=True),
+    show_default=True, help="stdin mode: weight of the previous keyframe's mask in each new one, "
+    "to reduce flicker; 0 = no smoothing")
+
 @click.option("-fs","face_scale", help="scale factor for face outline",default=1,show_default=True,
               type=click.FloatRange(min=0.1,max=10))
 
+@click.option("-ft","face_tracking",default=0,type=click.IntRange(0),
+    show_default=True, help="face model, stdin mode: track faces from frame to frame, "
+    "with full detection every N frames; 0 = detect faces in every frame")
+
+@click.option("-cvt","cv_threads",default=None,type=click.IntRange(0),
+    show_default=False, help="face model: number of threads OpenCV uses internally, "
+    "0 = number of cores divided by number of workers")
+
 @click.option("-bc","background_color", nargs=3, type=click.IntRange(0,255),default=[128,128,128],
     show_default=False, help="set background RGB color values, default: 128 128 128")
 
@@ -48,17 +163,47 @@ EPILOG = """The mask usage option (-mu, --mask-usage):
 
 @click.pass_context
 # not using **kwargs so I can see all options listed in one place
-def cli(ctx, model, mask_usage,invert_mask,threads,background_color,background_image,face_scale):
+def cli(ctx, model, model_map, model_memory_mb, mask_usage,invert_mask,threads,backend,pipeline,incremental,recursive,file_patterns,serve_queue,output_format,read_ahead,batch_size,batch_wait,peak_memory,engine,intra_threads,inter_threads,precision,calibration_dir,optimize,channels_last,inference_size,fit,refine_tile,mask_cache_dir,mask_cache_mb,keyframe_threshold,keyframe_interval,mask_smoothing,background_color,background_image,face_scale,face_tracking,cv_threads):
     # ensure that ctx.obj exists and is a dict (in case `cli()` is called
     # by means other than the `if` block below)
     ctx.ensure_object(dict)
     ctx.obj['model'] = model
+    ctx.obj['model_map'] = model_map
+    ctx.obj['model_memory_mb'] = model_memory_mb
     ctx.obj['mask_usage'] = mask_usage
     ctx.obj['invert_mask'] = invert_mask
     ctx.obj['threads'] = threads
+    ctx.obj['backend'] = backend
+    ctx.obj['pipeline'] = pipeline if pipeline else None
+    ctx.obj['incremental'] = incremental
+    ctx.obj['recursive'] = recursive
+    ctx.obj['file_patterns'] = list(file_patterns) if file_patterns else None
+    ctx.obj['serve_queue'] = serve_queue
+    ctx.obj['output_format'] = output_format
+    ctx.obj['read_ahead'] = read_ahead
+    ctx.obj['batch_size'] = batch_size
+    ctx.obj['batch_wait'] = batch_wait
+    ctx.obj['peak_memory'] = peak_memory
+    ctx.obj['engine'] = engine.lower()
+    ctx.obj['intra_threads'] = intra_threads
+    ctx.obj['inter_threads'] = inter_threads
+    ctx.obj['precision'] = precision.lower()
+    ctx.obj['calibration_dir'] = calibration_dir
+    ctx.obj['optimize'] = optimize.lower()
+    ctx.obj['channels_last'] = channels_last
+    ctx.obj['inference_size'] = inference_size
+    ctx.obj['fit'] = fit.lower()
+    ctx.obj['refine_tile'] = refine_tile
+    ctx.obj['mask_cache_dir'] = mask_cache_dir
+    ctx.obj['mask_cache_mb'] = mask_cache_mb
+    ctx.obj['keyframe_threshold'] = keyframe_threshold
+    ctx.obj['keyframe_interval'] = keyframe_interval
+    ctx.obj['mask_smoothing'] = mask_smoothing
     ctx.obj['background_color']=background_color
     ctx.obj['background_image']=background_image
     ctx.obj['face_scale']=face_scale
+    ctx.obj['face_tracking']=face_tracking
+    ctx.obj['cv_threads']=cv_threads
 
 @cli.command(name="file", help="process one image file")
 @click.argument("input_file", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True))
@@ -89,12 +234,44 @@ def cmd_dir(ctx,input_dir,output_dir):
 @click.argument("output_specifier", type=click.STRING)
 @click.pass_context
 def cmd_rs(ctx,image_width,image_height,output_specifier):
+    if ctx.obj['output_format']=='raw' and output_specifier=='-':
+        # frames go to stdout, so everything else must go to stderr
+        ctx.obj['raw_stdout']=sys.stdout.buffer
+        sys.stdout=sys.stderr
     print(f"Read RGB bytes from stdin, {image_width}x{image_height} images => {output_specifier}")
     import me2net_worker
     me2net_worker.CommonInit(ctx.obj)
     return me2net_worker.ReadStdin(ctx.obj,image_width,image_height,output_specifier)
     #print(ctx.obj)
 
+@cli.command(name="compare", help="compare masks made with the current options against reference masks")
+@click.argument("input_dir", type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True))
+@click.pass_context
+def cmd_compare(ctx,input_dir):
+    print(f"Compare masks, {input_dir} ...")
+    import me2net_worker
+    ctx.obj['batch_size']=1 # one image at a time, for timing
+    ctx.obj['mask_cache_dir']=None # every mask made for real
+    me2net_worker.CommonInit(ctx.obj)
+    return me2net_worker.CompareMasks(ctx.obj,input_dir)
+
+@cli.command(name="serve", help="keep the model loaded and process images sent over HTTP")
+@click.argument("address", type=click.STRING)
+@click.pass_context
+def cmd_serve(ctx,address):
+    """Process images sent over HTTP, on a TCP port (ADDRESS is HOST:PORT, or :PORT for all
+    interfaces) or a Unix socket (ADDRESS is unix:PATH). POST an encoded image to /composite to
+    get the output image as PNG, made as -mu, -bc and -bi say (?mu=0|1|2 overrides -mu), or to
+    /mask for the mask only. ?model= picks another model than -model for one request. GET /status
+    returns counters as JSON.
+
+    \b
+      python me2net.py -t 4 -bs 4 serve 127.0.0.1:8320
+      curl --data-binary @photo.jpg -o out.png http://127.0.0.1:8320/composite
+    """
+    import me2net_worker, me2net_server
+    me2net_worker.CommonInit(ctx.obj)
+    return me2net_server.Serve(ctx.obj,address)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,78 @@
+import os, json, threading
+
+# Progress of a dir mode run, for the -inc option. The manifest is a file in the output
+# directory, with one line for every input file whose output was saved: its name, size and
+# mtime. A rerun skips input files that are listed with the same size and mtime and whose
+# output file is still there, so it only processes new and changed files, and whatever an
+# interrupted run didn't get to.
+#
+# Lines are appended and flushed one at a time, as outputs are saved, so a killed run loses
+# at most the line being written, which is ignored when the manifest is read back. The first
+# line holds a signature of the options that change output files; if it doesn't match the
+# current options, the manifest is started over and everything is processed again.
+
+MANIFEST_FILE=".me2net_manifest"
+
+class Manifest:
+    def __init__(self,output_dir:str,signature:str):
+        self._path=os.path.join(output_dir,MANIFEST_FILE)
+        self._signature=signature
+        self._lck=threading.Lock()
+        self._done:dict={} # name: (size,mtime_ns)
+        self._nLines:int=0
+        if self._Read():
+            self._f=open(self._path,'a',encoding='utf-8')
+        else:
+            self._f=None
+            self._Rewrite()
+
+    def _Read(self) -> bool:
+        # False if there's no usable manifest
+        try:
+            f=open(self._path,'r',encoding='utf-8')
+        except OSError:
+            return False
+        with f:
+            try:
+                header=json.loads(f.readline())
+            except ValueError:
+                return False
+            if header.get('options')!=self._signature:
+                print(f"options changed since {self._path} was written, all files will be processed")
+                return False
+            for line in f:
+                try:
+                    name,size,mtime=json.loads(line)
+                except ValueError: # cut short when the last run was killed
+                    continue
+                self._done[name]=(size,mtime)
+                self._nLines=self._nLines+1
+        return True
+
+    def _Rewrite(self):
+        # write header and current entries to a new file, which replaces the old one
+        if self._f is not None: self._f.close()
+        tmp=f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp,'w',encoding='utf-8') as f:
+            f.write(json.dumps({'me2net_manifest':1,'options':self._signature})+"\n")
+            for name,(size,mtime) in self._done.items():
+                f.write(json.dumps([name,size,mtime])+"\n")
+        os.replace(tmp,self._path)
+        self._nLines=len(self._done)
+        self._f=open(self._path,'a',encoding='utf-8')
+
+    def IsDone(self,name:str,size:int,mtime_ns:int,output_file:str) -> bool:
+        return self._done.get(name)==(size,mtime_ns) and os.path.isfile(output_file)
+
+    def Record(self,name:str,size:int,mtime_ns:int):
+        with self._lck:
+            self._done[name]=(size,mtime_ns)
+            self._f.write(json.dumps([name,size,mtime_ns])+"\n")
+            self._f.flush()
+            self._nLines=self._nLines+1
+
+    def Close(self):
+        with self._lck:
+            # files that changed are listed more than once, drop the old lines
+            if self._nLines>2*len(self._done)+100: self._Rewrite()
+            self._f.close()
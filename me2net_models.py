@@ -0,0 +1,114 @@
+import os, sys, time, threading
+
+# Models other than the -model one, for jobs that pick a model per image: the -mm option's
+# model map in dir mode, ?model= in serve mode. Each model gets its own context, a copy of the
+# command line options with 'model' changed, set up by the same per-model init as the -model
+# one, so engine, precision, refinement and mask cache options apply to every model. The -model
+# model stays in the main context, as before, and is never unloaded.
+#
+# Models are loaded the first time an image needs them. With the -mms option, models that
+# weren't used for the longest time are unloaded when the loaded ones take more than that many
+# MB, estimated from the sizes of their files. A model is never unloaded while a worker is
+# using it, so the total can be over the limit for a while.
+
+MODELS=['u2net','u2netp','u2neths','face']
+
+class _Entry:
+    def __init__(self,ctx:dict,nBytes:int):
+        self.ctx=ctx
+        self.nBytes=nBytes
+        self.nUsers:int=0
+        self.lastUsed:float=time.monotonic()
+
+def _ModelBytes(ctx:dict) -> int:
+    return sum(os.stat(fn).st_size for fn in ctx['model_files'] if os.path.isfile(fn))
+
+class ModelRegistry:
+    def __init__(self,theCtx:dict,initModel,max_mb:float=0):
+        # initModel: the per-model init, called with a new context, returns 0 if it went well
+        # max_mb: 0 for no limit
+        self._options=theCtx['options']
+        self._initModel=initModel
+        self._maxBytes=int(max_mb*1048576)
+        self._lck=threading.Lock()
+        self._loadLck=threading.Lock() # one model is loaded at a time
+        self._default=theCtx['model']
+        self._models:dict={self._default:_Entry(theCtx,_ModelBytes(theCtx))}
+        self._failed=set() # models that couldn't be loaded, not tried again
+        self.nLoads:int=0
+        self.nUnloads:int=0
+
+    def Acquire(self,name:str) -> dict:
+        # returns the model's context, loaded if needed; Release(name) when done with it
+        if name not in MODELS: raise ValueError(f"unexpected model name: {name}")
+        e=self._Use(name)
+        if e is not None: return e.ctx
+        with self._loadLck:
+            e=self._Use(name) # another thread may have loaded it while we waited
+            if e is not None: return e.ctx
+            if name in self._failed: raise RuntimeError(f"model {name} could not be loaded")
+            ctx=dict(self._options)
+            ctx['model']=name
+            ctx['options']=dict(ctx)
+            print(f"loading model {name} ...")
+            if self._initModel(ctx)!=0:
+                self._failed.add(name)
+                raise RuntimeError(f"model {name} could not be loaded")
+            e=_Entry(ctx,_ModelBytes(ctx))
+            e.nUsers=1
+            with self._lck:
+                self._models[name]=e
+                self.nLoads=self.nLoads+1
+                unloaded=self._Evict()
+        self._Unload(unloaded)
+        return e.ctx
+
+    def Release(self,name:str):
+        with self._lck:
+            self._models[name].nUsers=self._models[name].nUsers-1
+            unloaded=self._Evict()
+        self._Unload(unloaded)
+
+    def _Use(self,name:str) -> _Entry:
+        with self._lck:
+            e=self._models.get(name)
+            if e is not None:
+                e.nUsers=e.nUsers+1
+                e.lastUsed=time.monotonic()
+            return e
+
+    def _Evict(self) -> list[_Entry]:
+        # called with the lock held, returns the entries taken out, to be unloaded without it
+        if self._maxBytes<=0: return []
+        total=sum(e.nBytes for e in self._models.values())
+        unloaded=[]
+        for name,e in sorted(self._models.items(),key=lambda x: x[1].lastUsed):
+            if total<=self._maxBytes: break
+            if name==self._default or e.nUsers>0: continue
+            del self._models[name]
+            total=total-e.nBytes
+            unloaded.append(e)
+        self.nUnloads=self.nUnloads+len(unloaded)
+        return unloaded
+
+    def _Unload(self,entries:list[_Entry]):
+        for e in entries:
+            print(f"unloading model {e.ctx['model']}")
+            if 'u2net_batcher' in e.ctx: e.ctx['u2net_batcher'].Stop()
+            e.ctx.clear() # drop the model, even if something still refers to the context
+        if len(entries)>0 and 'func_u2net' in sys.modules:
+            import func_u2net
+            if func_u2net.UsesCUDA(): func_u2net.torch.cuda.empty_cache()
+
+    def Loaded(self) -> list[str]:
+        with self._lck: return list(self._models.keys())
+
+    def Contexts(self) -> list[dict]:
+        # contexts of the loaded models other than the -model one
+        with self._lck: return [e.ctx for name,e in self._models.items() if name!=self._default]
+
+    def Report(self) -> str:
+        with self._lck:
+            mb=sum(e.nBytes for e in self._models.values())/1048576
+            return (f"models loaded: {', '.join(self._models.keys())}, about {mb:.0f} MB; "
+                    f"loads: {self.nLoads}, unloads: {self.nUnloads}")
@@ -0,0 +1,143 @@
+import time, threading, queue
+
+# A pipeline of stages connected by bounded queues. Each stage has its own pool of worker
+# threads, which take an item from the stage's input queue, call the stage function on it,
+# and put the result into the next stage's input queue. Queues are bounded, so a slow stage
+# makes the stages before it wait, instead of letting items pile up in memory.
+#
+# A stage function is called as fn(item,state) and returns the item to pass on, or None to
+# drop it (for example when an input file couldn't be loaded). state is a dict private to
+# the calling worker thread, for things like cached buffers.
+
+_END=object() # end-of-input marker
+
+class _Stage:
+    def __init__(self,name:str,fn,nWorkers:int,qsize:int):
+        self.name=name
+        self.fn=fn
+        self.nWorkers=nWorkers
+        self.q=queue.Queue(qsize)
+        self.lck=threading.Lock()
+        self.nRunning:int=0
+        self.nIn:int=0     # items taken from input queue
+        self.nOut:int=0    # items passed on
+        self.busy:float=0  # seconds spent in fn, summed over all workers
+
+class Pipeline:
+    def __init__(self,lck:threading.Lock,on_drop=None):
+        self._lck=lck # use this lock when printing to console
+        self._on_drop=on_drop # if not None, called with every item that a stage dropped
+        self._stages:list[_Stage]=[]
+        self._workers:list[threading.Thread]=[]
+        self._t0:float=0
+        self._t1:float=0
+
+    def AddStage(self,name:str,fn,nWorkers:int,qsize:int=0):
+        # qsize defaults to twice the number of workers, enough to keep them all busy
+        if qsize<1: qsize=2*nWorkers
+        self._stages.append(_Stage(name,fn,nWorkers,qsize))
+
+    def Start(self):
+        self._t0=time.perf_counter()
+        for i,st in enumerate(self._stages):
+            st.nRunning=st.nWorkers
+            for j in range(st.nWorkers):
+                wt=threading.Thread(target=self._stage_worker_thread,args=[i])
+                wt.start()
+                self._workers.append(wt)
+
+    def Put(self,item):
+        # blocks while the first stage's input queue is full
+        self._stages[0].q.put(item)
+
+    def TryPut(self,item) -> bool:
+        # like Put, but returns False at once instead of waiting while the queue is full
+        try:
+            self._stages[0].q.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def Queued(self) -> int:
+        # number of items waiting in the first stage's input queue
+        return self._stages[0].q.qsize()
+
+    def Finish(self):
+        # signal end of input, then wait for all items to go through the pipeline
+        st=self._stages[0]
+        for i in range(st.nWorkers): st.q.put(_END)
+        for wt in self._workers: wt.join()
+        self._t1=time.perf_counter()
+
+    def Completed(self) -> int:
+        # number of items that made it through the last stage
+        return self._stages[-1].nOut
+
+    def Report(self) -> str:
+        wall=max(self._t1-self._t0,1e-6)
+        lines=[]
+        for st in self._stages:
+            ms=1000*st.busy/st.nIn if st.nIn>0 else 0
+            lines.append(f"stage {st.name}: {st.nWorkers} worker(s), {st.nIn} in, {st.nOut} out, "
+                         f"{ms:.1f} ms/item, {st.nOut/wall:.2f} items/s, "
+                         f"{100*st.busy/(wall*st.nWorkers):.0f}% busy")
+        return "\n".join(lines)
+
+    def _stage_worker_thread(self,idx:int):
+        st=self._stages[idx]
+        nxt=self._stages[idx+1] if idx+1<len(self._stages) else None
+        state={}
+        while True:
+            item=st.q.get()
+            if item is _END: break
+            t0=time.perf_counter()
+            inItem=item
+            try:
+                item=st.fn(item,state)
+            except Exception as e:
+                with self._lck: print(f"thread {threading.get_native_id()} stage {st.name} exception {type(e)}: {e}")
+                item=None
+            t1=time.perf_counter()
+            with st.lck:
+                st.nIn=st.nIn+1
+                st.busy=st.busy+t1-t0
+                if item is not None: st.nOut=st.nOut+1
+            if item is None:
+                if self._on_drop is not None: self._on_drop(inItem)
+            elif nxt is not None: nxt.q.put(item)
+
+        # the last worker of this stage to exit tells the next stage there's no more input
+        with st.lck:
+            st.nRunning=st.nRunning-1
+            last=(st.nRunning==0)
+        if last and nxt is not None:
+            for i in range(nxt.nWorkers): nxt.q.put(_END)
+
+class ReorderBuffer:
+    # Items go through a pipeline out of order, this puts them back in order. Put() is
+    # called with an item's index, which must start at 0 and have no gaps, and the
+    # item's data. Data is passed to write() in index order, as soon as all items before
+    # it have been written. Items that failed must still be Put(), with data None, so
+    # that the items after them aren't held back forever.
+    def __init__(self,write):
+        self._write=write
+        self._lck=threading.Lock()
+        self._pending:dict={}
+        self.nextIndex:int=0
+        self.error:Exception=None # set if write() failed, nothing is written after that
+
+    def Put(self,index:int,data):
+        with self._lck:
+            self._pending[index]=data
+            while self.nextIndex in self._pending:
+                data=self._pending.pop(self.nextIndex)
+                self.nextIndex=self.nextIndex+1
+                if self.error is not None: continue
+                try:
+                    self._write(data)
+                except Exception as e:
+                    self.error=e
+
+    def Pending(self) -> int:
+        # number of items waiting for an item before them
+        with self._lck: return len(self._pending)
@@ -0,0 +1,192 @@
+import os, sys, io, json, stat, threading, signal, socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import me2net_worker
+from me2net_models import MODELS
+
+# Serve mode: models are loaded once, then images are processed as they come in over HTTP,
+# on a TCP port or a Unix socket, so callers don't pay for starting Python, importing torch
+# and loading the weights with every image. Requests go through the same pipeline as dir and
+# stdin modes, so -t, -ps, -bs and -mc work the same way here.
+#
+#   POST /composite   body is an encoded image, the response is the output image as PNG,
+#                     made as the -mu, -bc and -bi options say; ?mu=0|1|2 overrides -mu,
+#                     and ?model= picks another model than -model, see me2net_models
+#   POST /mask        same, with the mask only
+#   GET  /status      counters, as JSON
+#
+# Requests waiting for a worker are held in a queue of fixed size, set by -sq. When it's full, requests
+# are turned away at once with 503 and a Retry-After header, instead of piling up, so callers
+# can back off or try another server. This is checked before the request body is read, so a
+# burst of large uploads doesn't take up memory for requests that would be turned away anyway.
+
+_MAX_BODY=64*1048576 # bytes, larger requests are turned away with 413
+
+class _Reply:
+    # where a pipeline item's output goes, and the handler thread waits for it
+    def __init__(self):
+        self._done=threading.Event()
+        self.data:bytes=None
+
+    def Done(self,data:bytes):
+        # data: PNG bytes, None if the item failed
+        self.data=data
+        self._done.set()
+
+    def Wait(self) -> bytes:
+        self._done.wait()
+        return self.data
+
+class _Server:
+    def __init__(self,theCtx:dict,queue_size:int):
+        self.theCtx=theCtx
+        self.lck=threading.Lock() # use this lock when printing to console, and for counters
+        self.nServed:int=0
+        self.nRejected:int=0
+        self.nFailed:int=0
+        self.nRequests:int=0
+        self.queue_size=queue_size
+        self.pl=me2net_worker._BuildPipeline(theCtx,self.lck,theCtx['threads'],self._on_drop,queue_size)
+
+    def _on_drop(self,item:dict):
+        item['reply'].Done(None)
+
+    def Full(self) -> bool:
+        return self.pl.Queued()>=self.queue_size
+
+    def Reject(self):
+        # a request turned away before its body was read
+        with self.lck:
+            self.nRequests=self.nRequests+1
+            self.nRejected=self.nRejected+1
+
+    def Submit(self,body:bytes,mu:str,model:str) -> tuple[int,bytes]:
+        # returns HTTP status, and PNG bytes if it's 200
+        with self.lck:
+            self.nRequests=self.nRequests+1
+            name=f"request#{self.nRequests}"
+        reply=_Reply()
+        item={'name':name,'input_file':io.BytesIO(body),'output_file':"response",'mask_usage':mu,'reply':reply}
+        if model is not None: item['model']=model
+        if not self.pl.TryPut(item):
+            with self.lck: self.nRejected=self.nRejected+1
+            return 503,None
+        data=reply.Wait()
+        with self.lck:
+            if data is None: self.nFailed=self.nFailed+1
+            else: self.nServed=self.nServed+1
+        return (200 if data is not None else 422),data
+
+    def Status(self) -> dict:
+        with self.lck:
+            return {'model':self.theCtx['model'],'loaded':self.theCtx['models'].Loaded(),'queued':self.pl.Queued(),'requests':self.nRequests,
+                    'served':self.nServed,'rejected':self.nRejected,'failed':self.nFailed}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1" # keep connections open between requests
+    server_version="me2net"
+
+    def _Send(self,status:int,data:bytes,contentType:str,headers:dict=None):
+        self.send_response(status)
+        self.send_header("Content-Type",contentType)
+        self.send_header("Content-Length",str(len(data)))
+        for k,v in (headers or {}).items(): self.send_header(k,v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _SendError(self,status:int,message:str,headers:dict=None):
+        self._Send(status,(json.dumps({'error':message})+"\n").encode(),"application/json",headers)
+
+    def do_GET(self):
+        if urlsplit(self.path).path!="/status": return self._SendError(404,"not found")
+        self._Send(200,(json.dumps(self.server.me2net.Status())+"\n").encode(),"application/json")
+
+    def do_POST(self):
+        url=urlsplit(self.path)
+        length=int(self.headers.get("Content-Length") or 0)
+        if url.path not in ("/composite","/mask"):
+            self.close_connection=True # body not read
+            return self._SendError(404,"not found")
+        if length<=0:
+            return self._SendError(411,"an image is required as request body, with Content-Length")
+        if length>_MAX_BODY:
+            self.close_connection=True
+            return self._SendError(413,f"image larger than {_MAX_BODY} bytes")
+        if self.server.me2net.Full(): # don't read the body of a request that would be turned away
+            self.server.me2net.Reject()
+            self.close_connection=True
+            return self._SendError(503,"too many requests waiting, try again later",{"Retry-After":"1","Connection":"close"})
+        body=self.rfile.read(length)
+
+        query=parse_qs(url.query)
+        if url.path=="/mask":
+            mu='2'
+        else:
+            mu=query.get('mu',[None])[0]
+            if mu not in (None,'0','1','2'): return self._SendError(400,f"unexpected mu value: {mu}")
+        model=query.get('model',[None])[0]
+        if model not in [None]+MODELS: return self._SendError(400,f"unexpected model: {model}")
+        status,data=self.server.me2net.Submit(body,mu,model)
+        if status==503: return self._SendError(503,"too many requests waiting, try again later",{"Retry-After":"1"})
+        if status!=200: return self._SendError(status,"image could not be processed")
+        self._Send(200,data,"image/png")
+
+    def log_request(self,code='-',size='-'):
+        pass # processed images are printed by the pipeline
+
+    def address_string(self) -> str:
+        # a Unix socket's client has no address
+        return self.client_address[0] if self.client_address else "unix"
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    daemon_threads=True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name="localhost" # for BaseHTTPRequestHandler, like HTTPServer
+        self.server_port=0
+
+def _AddressError(message:str) -> Exception:
+    import click
+    return click.BadParameter(message,param_hint="ADDRESS")
+
+def _CreateServer(address:str):
+    # address: HOST:PORT, :PORT for all interfaces, or unix:PATH
+    if address.startswith("unix:"):
+        path=address[5:]
+        if not hasattr(socketserver,'UnixStreamServer'):
+            raise _AddressError(f"Unix sockets aren't supported on this platform: {address}")
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode): raise _AddressError(f"{path} exists and isn't a socket")
+            os.remove(path) # left behind by a server that was killed
+        return _UnixHTTPServer(path,_Handler),path
+    host,sep,port=address.rpartition(":")
+    if sep=="" or not port.isdigit(): raise _AddressError(f"expected HOST:PORT or unix:PATH, not {address}")
+    return ThreadingHTTPServer((host,int(port)),_Handler),None
+
+def _on_sigterm(signum,frame):
+    raise KeyboardInterrupt() # stop the same way as with Ctrl+C
+
+def Serve(theCtx:dict,address:str) -> int:
+    queue_size=theCtx['serve_queue']
+    srv=_Server(theCtx,queue_size)
+    server,unixPath=_CreateServer(address)
+    server.me2net=srv
+    srv.pl.Start()
+    if threading.current_thread() is threading.main_thread(): signal.signal(signal.SIGTERM,_on_sigterm)
+    print(f"serving on {address}, {theCtx['threads'] if theCtx['pipeline'] is None else sum(theCtx['pipeline'])} "
+          f"worker thread(s), at most {queue_size} request(s) waiting, Ctrl+C to stop")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nstopping ...")
+    finally:
+        server.server_close()
+        if unixPath is not None and os.path.exists(unixPath): os.remove(unixPath)
+        srv.pl.Finish() # requests already taken in are finished
+    s=srv.Status()
+    print(f"requests: {s['requests']}, served: {s['served']}, rejected: {s['rejected']}, failed: {s['failed']}")
+    me2net_worker._ReportPipeline(theCtx,srv.pl)
+    return 0
@@ -1,24 +1,104 @@
-import os, sys, time, threading, queue
+import os, sys, io, time, json, threading, queue, functools, fnmatch
+import numpy as np
 from PIL import Image
+from me2net_pipeline import Pipeline, ReorderBuffer
+from me2net_manifest import Manifest
+from me2net_models import ModelRegistry, MODELS
 
 def CommonInit(theCtx:dict):
+    # keep a copy of the command line options, for worker processes that need to
+    # initialize their own context
+    theCtx['options']=dict(theCtx)
     _PrepareBackgroundImage(theCtx)
-    if theCtx['model'] in ['u2net','u2netp','u2neths']:
+    i=_InitModel(theCtx)
+    if i!=0: sys.exit(i)
+    # other models, loaded when an image needs them
+    theCtx['models']=ModelRegistry(theCtx,_InitModel,theCtx['model_memory_mb'])
+    if theCtx['model_map'] is not None:
+        theCtx['model_rules']=_ReadModelMap(theCtx['model_map'])
+        if theCtx['model_rules'] is None: sys.exit(-1)
+
+def _InitModel(theCtx:dict) -> int:
+    # sets up theCtx['model'] in theCtx, returns 0 if it went well
+    if theCtx['model'] in ['u2net','u2netp','u2neths'] and theCtx['engine']=='onnxruntime':
+        global func_onnx
+        import func_onnx
+        session=func_onnx.GetU2NetSession(theCtx['model'],theCtx['intra_threads'],theCtx['inter_threads'])
+        if session is None: return -1
+        theCtx['u2net_onnx']=session
+        theCtx['model_files']=[func_onnx.GetONNXFile(theCtx['model'])]
+        if theCtx['batch_size']>1:
+            theCtx['u2net_batcher']=func_onnx.GetU2NetBatcher(session,theCtx['batch_size'],theCtx['batch_wait']/1000)
+        theCtx['GetForeGroundMask']=func_onnx.GetForegroundMask
+    elif theCtx['model'] in ['u2net','u2netp','u2neths']:
         global func_u2net
         import func_u2net
-        net=func_u2net.GetU2NetModel(theCtx['model'])
-        if net is None: sys.exit(-1)
+        channels_last=theCtx['channels_last']
+        if theCtx['precision']=='int8':
+            import func_quant
+            net=func_quant.GetQuantizedU2NetModel(theCtx['model'],theCtx['calibration_dir'])
+            channels_last=False # layout was fixed when it was quantized
+        elif theCtx['optimize']!='none':
+            import func_opt
+            net=func_opt.OptimizeU2NetModel(theCtx['model'],theCtx['optimize'],theCtx['precision'],channels_last)
+        else:
+            net=func_u2net.GetU2NetModel(theCtx['model'])
+        if net is None: return -1
+        net=func_u2net.InferenceRuntime(net,theCtx['peak_memory'],theCtx['precision'],channels_last)
         theCtx['u2net']=net
+        theCtx['model_files']=[func_u2net.GetU2NetModelFile(theCtx['model'])]
+        if theCtx['batch_size']>1:
+            theCtx['u2net_batcher']=func_u2net.GetU2NetBatcher(net,theCtx['batch_size'],theCtx['batch_wait']/1000)
         # function pointer: Image* (*GetForegroundMask)(Dict&,Image&)
         theCtx['GetForeGroundMask']=func_u2net.GetForegroundMask
     else:
         global func_mp
         import func_mp
         i=func_mp.InitMediaPipe(theCtx)
-        if i!=0: sys.exit(i)
+        if i!=0: return i
         
         theCtx['GetForeGroundMask']=func_mp.GetFaceMask
- 
+        theCtx['model_files']=[func_mp.LANDMARKER_FILE,func_mp.HAAR_CASCADE_FILE]
+
+    if theCtx['refine_tile']>0 and theCtx['model']!='face':
+        # works with any engine, by running its mask function again on tiles of the image
+        import func_resolution
+        theCtx['GetForeGroundMask']=functools.partial(func_resolution.RefinedMask,theCtx['GetForeGroundMask'])
+
+    if theCtx['mask_cache_dir'] is not None:
+        # in front of everything else that makes masks
+        import func_cache
+        cache=func_cache.MaskCache(theCtx,theCtx['mask_cache_dir'],theCtx['mask_cache_mb'],theCtx['model_files'])
+        theCtx['mask_cache']=cache
+        theCtx['GetForeGroundMask']=functools.partial(cache.GetMask,theCtx['GetForeGroundMask'])
+    return 0
+
+def _ReadModelMap(model_map:str) -> list[tuple[str,str]]:
+    # Lines of the -mm file are "PATTERN MODEL", the first line whose pattern matches an input
+    # file's path (relative to the input directory, with / between directories) says which
+    # model makes its mask. Files that no line matches use the -model model. Returns the
+    # (pattern,model) pairs, None if the file has errors.
+    rules=[]
+    with open(model_map,'r',encoding='utf-8') as f:
+        for n,line in enumerate(f,1):
+            line=line.strip()
+            if line=="" or line.startswith("#"): continue
+            fields=line.rsplit(None,1)
+            if len(fields)!=2 or fields[1] not in MODELS:
+                print(f"{model_map} line {n}: expected a file name pattern and one of {', '.join(MODELS)}")
+                return None
+            rules.append((fields[0],fields[1]))
+    return rules
+
+def _ModelFor(theCtx:dict,fn:str) -> str:
+    # model for input file fn, from the -mm file, None for the -model one
+    rules=theCtx.get('model_rules')
+    if rules is None: return None
+    fn=fn.replace(os.sep,"/")
+    for pattern,model in rules:
+        if fnmatch.fnmatchcase(fn,pattern): return model
+    return None
+
 def _AdjustBackgroundImage(bgOriginal:Image,bgCached:Image,toSize,toMode)->Image:
     if bgOriginal is None: return None
 
@@ -37,7 +117,21 @@ def _AdjustBackgroundImage(bgOriginal:Image,bgCached:Image,toSize,toMode)->Image
     return bgCached
 
 
+def _SolidBackground(theCtx:dict,size)->Image:
+    # a solid color background only depends on image size, so make it once and share it
+    # between threads, it's never modified. Dir mode can have images of any size, so
+    # don't keep more than a few. It's RGB even for grayscale input images, so that those
+    # are blended in color, as before.
+    cache:dict=theCtx['solid_backgrounds']
+    bg=cache.get(size)
+    if bg is None:
+        bg=Image.new('RGB',size,tuple(theCtx['background_color']))
+        if len(cache)>=8: cache.clear()
+        cache[size]=bg
+    return bg
+
 def _PrepareBackgroundImage(theCtx:dict):
+    theCtx['solid_backgrounds']={} # see _SolidBackground
     if theCtx['background_image'] is None: 
         theCtx['bgimg_loaded']=None
         return
@@ -54,44 +148,88 @@ def _PrepareBackgroundImage(theCtx:dict):
     theCtx['bgimg_loaded']=i1
 
 
-def _SaveOutputFile(theCtx:dict,inputImg:Image,maskImg:Image,imgBG:Image,output_file:str) -> int :
-    
-    mu=theCtx['mask_usage']
+def _ComposeOutput(theCtx:dict,inputImg:Image,maskImg:Image,imgBG:Image,inPlace:bool=False,mu:str=None) -> Image :
+    # inPlace: inputImg isn't needed afterwards, with -mu 1 the mask is added to it instead of a copy
+    # mu: mask usage if not the -mu option's
+    if mu is None: mu=theCtx['mask_usage']
     if (mu=='2'): #mask only
-        maskImg.save(output_file)
+        return maskImg
     elif (mu=='1'): #input image + mask
-        imgC=inputImg.copy()
+        imgC=inputImg if inPlace else inputImg.copy()
         imgC.putalpha(maskImg)
-        imgC.save(output_file)
         #print(f"{output_file} {inputImg.mode} {imgC.mode}")
+        return imgC
     elif (mu=='0'): #alpha blend input image with a solid color or background image
         if imgBG is None:
-            imgBG = Image.new('RGB', inputImg.size, theCtx['background_color'])
+            imgBG = _SolidBackground(theCtx,inputImg.size)
         #print(f"{inputImg.size} {imgBG.size}")    
         imgC=Image.composite(inputImg,imgBG,maskImg)
         #imgC=inputImg #testing cx
-        imgC.save(output_file,format="PNG")
+        return imgC
     else:
         print(f"unexpected output mode: {mu}")
-        return -1
+        return None
+
+def _WriteOutputFile(theCtx:dict,imgC:Image,output_file:str):
+    # blended images are always saved as PNG, otherwise format is determined by file extension
+    if theCtx['mask_usage']=='0': fmt="PNG"
+    else: fmt=Image.registered_extensions().get(os.path.splitext(output_file)[1].lower())
+    # saved under another name first, so that a killed run never leaves a partial file
+    tmp=f"{output_file}.{os.getpid()}.{threading.get_native_id()}.tmp"
+    try:
+        imgC.save(tmp,format=fmt)
+        os.replace(tmp,output_file)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+def _SaveOutputFile(theCtx:dict,inputImg:Image,maskImg:Image,imgBG:Image,output_file:str) -> int :
+    imgC=_ComposeOutput(theCtx,inputImg,maskImg,imgBG,True)
+    if imgC is None: return -1
+    _WriteOutputFile(theCtx,imgC,output_file)
     return 0
 
-def _GetForegroundMask(theCtx:dict,i1:Image) -> Image:
-    return theCtx['GetForeGroundMask'](theCtx,i1)
+def _ReportBatching(theCtx:dict):
+    if 'u2net_batcher' in theCtx: print(theCtx['u2net_batcher'].Report())
+    if 'face_tracker' in theCtx: print(theCtx['face_tracker'].Report())
+    if 'keyframes' in theCtx: print(theCtx['keyframes'].Report())
+    if 'mask_cache' in theCtx: print(theCtx['mask_cache'].Report())
+    if 'refine_images' in theCtx: print(f"refined images: {theCtx['refine_images']}, tiles: {theCtx['refine_tiles']}")
+    if 'models' in theCtx and theCtx['models'].nLoads>0:
+        print(theCtx['models'].Report())
+        for ctx in theCtx['models'].Contexts():
+            if any(k in ctx for k in ['u2net_batcher','mask_cache','refine_images']):
+                print(f"model {ctx['model']}:")
+                _ReportBatching(ctx)
+
+def _GetForegroundMask(theCtx:dict,i1:Image,pixels=None,model:str=None) -> Image:
+    # pixels: optional numpy array with the same content as i1, see _FrameBufferPool
+    # model: if not None and not the -model one, the mask is made by this model
+    if model is None or model==theCtx['model']:
+        return theCtx['GetForeGroundMask'](theCtx,i1,pixels)
+    registry:ModelRegistry=theCtx['models']
+    ctx=registry.Acquire(model)
+    try:
+        return ctx['GetForeGroundMask'](ctx,i1,pixels)
+    finally:
+        registry.Release(model)
     #if theCtx['model'] in ['u2net','u2netp', 'u2neths']:
     #    return u2net_func.GetForegroundMask(theCtx,i1)
     #else:
     #    return mp_func.GetFaceMask(theCtx,i1)
     
-def _LoadInputImage(input_file:str) -> Image:
+def _LoadInputImage(input_file,name:str=None) -> Image:
+    # input_file: file name, or file object with name to print
+    if name is None: name=input_file
     try:
         i1 = Image.open(input_file)
+        i1.load() # decode now, so that errors in the file show up here
         if i1.mode != "L" and i1.mode != "RGB":
-            print(f"    converting {input_file} from mode {i1.mode} to RGB")
+            print(f"    converting {name} from mode {i1.mode} to RGB")
             i1 = i1.convert("RGB")
     except Exception as inst:
         print(type(inst),':',inst)
-        print(f"{input_file} : could not load successfully")
+        print(f"{name} : could not load successfully")
         return None
     return i1
 
@@ -105,93 +243,411 @@ def ProcessOneFile(theCtx:dict,input_file:str,output_file:str) -> int:
         print("output file saved successfully")
 
 
-def _dir_worker_thread(theCtx:dict, lck:threading.Lock, input_dir:str, output_dir:str, 
-                       items:list[str], idx0:int, idx1:int):
-    with lck: print(f"thread {threading.get_native_id()} running ...")
-    bgImg=theCtx['bgimg_loaded']
-    nOK:int=int(0)
-    while idx0<idx1:
-        fn=items[idx0]
-        idx0=idx0+1
+def _ProcessDirItem(theCtx:dict, lck:threading.Lock, input_dir:str, output_dir:str, fn:str,
+                    bgImg:Image, who:str) -> tuple[int,Image]:
+    # returns (1 if output file was saved else 0, background image adjusted for this item)
+    input_file=os.path.join(input_dir,fn)
+    if not os.path.isfile(input_file): return 0,bgImg
+    i1=_LoadInputImage(input_file)
+    if i1 is None: return 0,bgImg
 
-        input_file=os.path.join(input_dir,fn)
-        if not os.path.isfile(input_file): continue
-        i1=_LoadInputImage(input_file)
-        if i1 is None: continue
+    output_file=_OutputFileName(output_dir,fn)
+    with lck:
+        print(f"{who}: {input_file} => {output_file} ...")
+    maskImg:Image=_GetForegroundMask(theCtx,i1,None,_ModelFor(theCtx,fn))
+    bgImg=_AdjustBackgroundImage(theCtx['bgimg_loaded'],bgImg,i1.size,i1.mode)
+    if 0==_SaveOutputFile(theCtx,i1,maskImg,bgImg,output_file): return 1,bgImg
+    return 0,bgImg
+
+# Pipeline stages for dir and stdin modes. Work items are dicts, with these keys:
+#   name        : item name to print
+#   input_file  : input image file name in dir mode, or file object with the encoded image in serve mode
+#   img         : input image, loaded by decode stage in dir mode, or by reader in stdin mode
+#   frame       : stdin mode only, the _FrameBuffer that img was made from
+#   mask_future : stdin mode only, with -kt or -tsm options, MaskFuture to get the mask from
+#   mask        : foreground mask, set by infer stage
+#   output      : image to save, set by composite stage
+#   output_file : output file name
+#   stat        : dir mode with -inc only, (name,size,mtime_ns) of input file for the manifest
+#   model       : dir mode with -mm, or serve mode, model to make the mask with if not the -model one
+#   mask_usage  : serve mode only, mask usage of this request
+#   reply       : serve mode only, the output goes there as PNG bytes instead of to output_file
+
+def _StageDecode(theCtx:dict,lck:threading.Lock,item:dict,state:dict) -> dict:
+    if 'img' not in item:
+        i1=_LoadInputImage(item['input_file'],item['name'])
+        if i1 is None: return None
+        item['img']=i1
+    with lck:
+        print(f"thread {threading.get_native_id()}: {item['name']} => {item['output_file']} ...")
+    return item
+
+def _StageInfer(theCtx:dict,lck:threading.Lock,item:dict,state:dict) -> dict:
+    if 'mask_future' in item: # maybe computed from another frame, see func_temporal
+        item['mask']=item.pop('mask_future').Get()
+    else:
+        pixels=None
+        if 'frame' in item: pixels=item['frame'].pixels
+        item['mask']=_GetForegroundMask(theCtx,item['img'],pixels,item.get('model'))
+    if 'frame' in item: item.pop('frame').Release() # model was the last user of the frame buffer
+    return item
+
+def _StageComposite(theCtx:dict,lck:threading.Lock,item:dict,state:dict) -> dict:
+    i1=item['img']
+    # each worker keeps its own copy of the background image, adjusted to the last input image
+    bgImg=state.get('bgimg',theCtx['bgimg_loaded'])
+    bgImg=_AdjustBackgroundImage(theCtx['bgimg_loaded'],bgImg,i1.size,i1.mode)
+    state['bgimg']=bgImg
+    imgC=_ComposeOutput(theCtx,i1,item.pop('mask'),bgImg,True,item.get('mask_usage'))
+    if imgC is None: return None
+    del item['img'] # not needed anymore, let it go before the item waits in encode stage's queue
+    item['output']=imgC
+    return item
+
+def _StageEncode(theCtx:dict,lck:threading.Lock,item:dict,state:dict) -> dict:
+    if 'frame_writer' in theCtx: # raw frames, written in order by the reorder buffer
+        theCtx['frame_writer'].Put(item['index'],item.pop('output').tobytes())
+    elif 'reply' in item: # serve mode, see me2net_server
+        buf=io.BytesIO()
+        item.pop('output').save(buf,format="PNG")
+        item['reply'].Done(buf.getvalue())
+    else:
+        _WriteOutputFile(theCtx,item.pop('output'),item['output_file'])
+        if 'stat' in item: theCtx['manifest'].Record(*item['stat'])
+    return item
+
+_STAGES=[("decode",_StageDecode),("infer",_StageInfer),("composite",_StageComposite),("encode",_StageEncode)]
+
+def _StageAll(theCtx:dict,lck:threading.Lock,item:dict,state:dict) -> dict:
+    for name,fn in _STAGES:
+        item=fn(theCtx,lck,item,state)
+        if item is None: break
+    return item
+
+def _BuildPipeline(theCtx:dict,lck:threading.Lock,nThreads:int,on_drop=None,qsize:int=0) -> Pipeline:
+    # Without the -ps option, every worker runs all stages for one item before taking
+    # the next one. With it, each stage gets its own pool of workers.
+    # qsize: size of the first stage's input queue, 0 for the default
+    pl=Pipeline(lck,on_drop)
+    if theCtx['pipeline'] is None:
+        pl.AddStage("process",functools.partial(_StageAll,theCtx,lck),nThreads,qsize)
+    else:
+        for i,((name,fn),n) in enumerate(zip(_STAGES,theCtx['pipeline'])):
+            pl.AddStage(name,functools.partial(fn,theCtx,lck),n,qsize if i==0 else 0)
+    return pl
+
+# raw output pixel format for each mask usage, as named by FFMPEG, and bytes per pixel
+_RAW_FORMATS={'0':("rgb24",3), '1':("rgba",4), '2':("gray",1)}
+
+def _OpenRawOutput(theCtx:dict,output_specifier:str,bytesPerFrame:int):
+    # "-" means stdout, anything else is a file name or a named pipe
+    # returns (reorder buffer that writes frames, file object to close when done)
+    f=theCtx['raw_stdout'] if output_specifier=='-' else open(output_specifier,'wb')
+    def _write_frame(data:bytes):
+        # failed frames are written as all zero bytes, to keep later frames at the right time
+        f.write(data if data is not None else bytes(bytesPerFrame))
+    return ReorderBuffer(_write_frame),f
+
+def _CloseRawOutput(theCtx:dict,writer:ReorderBuffer,f):
+    try:
+        if f is theCtx.get('raw_stdout'): f.flush()
+        else: f.close()
+    except OSError as e:
+        if writer.error is None: writer.error=e
+
+def _ReportPipeline(theCtx:dict,pl:Pipeline):
+    print(pl.Report())
+    _ReportBatching(theCtx)
+
+_WALK_CHUNK=256 # files sorted by size at a time
+
+def _MatchFile(name:str,extensions:set,patterns:list[str]) -> bool:
+    if patterns is not None: return any(fnmatch.fnmatchcase(name.lower(),p) for p in patterns)
+    return os.path.splitext(name)[1].lower() in extensions
+
+def _WalkDirItems(input_dir:str,recursive:bool=False,patterns:list[str]=None,output_dir:str=None):
+    # Yields (name,size,mtime_ns) of the image files in input_dir, and with recursive in its
+    # subdirectories too, name being the path relative to input_dir. Files are yielded as they
+    # are found, so processing starts before a big directory is fully listed. Without
+    # patterns, image files are those with an extension that PIL knows, so nobody tries to
+    # open every other file as an image. With patterns, those whose name matches any of them.
+    # output_dir isn't walked if it's inside input_dir. A directory that its own output files
+    # go to (output_dir is input_dir, or links to it) is read to the end before any of its
+    # files are yielded, or the walk would find the output files written in the meantime.
+    #
+    # Up to _WALK_CHUNK files of a directory are yielded largest first. Workers take files one
+    # at a time as they become idle, so handing out the big files early means nobody is left
+    # processing a big file at the end while the others are done.
+    extensions=set(Image.registered_extensions())
+    if patterns is not None: patterns=[p.lower() for p in patterns]
+    skip=os.path.realpath(output_dir) if output_dir is not None else None
+    dirs=[""]
+    while len(dirs)>0:
+        rel=dirs.pop()
+        chunk=[]
+        chunkSize=_WALK_CHUNK
+        if output_dir is not None and os.path.realpath(os.path.join(input_dir,rel))==os.path.realpath(os.path.join(output_dir,rel)):
+            chunkSize=sys.maxsize # the whole directory in one chunk
+        try:
+            it=os.scandir(os.path.join(input_dir,rel))
+        except OSError as e:
+            print(f"could not read directory {os.path.join(input_dir,rel)}, {e}")
+            continue
+        with it:
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=False): # not following links, which may loop
+                        if recursive and os.path.realpath(e.path)!=skip: dirs.append(os.path.join(rel,e.name))
+                    elif _MatchFile(e.name,extensions,patterns) and e.is_file():
+                        st=e.stat()
+                        chunk.append((os.path.join(rel,e.name),st.st_size,st.st_mtime_ns))
+                except OSError: # vanished or unreadable, skip it
+                    continue
+                if len(chunk)>=chunkSize:
+                    chunk.sort(key=lambda x: x[1], reverse=True)
+                    yield from chunk
+                    chunk=[]
+        chunk.sort(key=lambda x: x[1], reverse=True)
+        yield from chunk
+
+def _ListDirItems(theCtx:dict,input_dir:str) -> list[str]:
+    return [x[0] for x in _WalkDirItems(input_dir,theCtx['recursive'],theCtx['file_patterns'])]
+
+def _OutputSignature(theCtx:dict) -> str:
+    # the options that change output files, for the manifest of -inc
+    import func_cache
+    keys=func_cache.MASK_OPTIONS+['mask_usage','background_color','background_image']
+    sig={k:theCtx.get(k) for k in keys}
+    sig['background_color']=list(sig['background_color'])
+    if theCtx['background_image'] is not None: # same name, but maybe not the same image
+        st=os.stat(theCtx['background_image'])
+        sig['background_image_stat']=[st.st_size,st.st_mtime_ns]
+    if theCtx.get('model_rules') is not None: sig['model_map']=theCtx['model_rules']
+    return json.dumps(sig,sort_keys=True)
+
+# State of a worker process when running with "-backend process". With the fork start method,
+# _process_ctx is set by the parent before the pool is created, so children inherit the
+# models already loaded by the parent, and the weights are shared copy-on-write. Otherwise,
+# every worker process loads the models itself from the command line options.
+_process_ctx:dict=None
+_process_bg:Image=None
+_process_lck=threading.Lock()
+_process_init_error:str=None
+
+def _process_worker_init(options:dict, nProcesses:int):
+    global _process_ctx, _process_bg, _process_init_error
+    # an exception (or sys.exit) here would make the pool restart this process over
+    # and over, so any failure is recorded and reported by the first job instead
+    try:
+        if options is None: # forked, context inherited from parent
+            # the batcher's thread isn't copied into a forked process, and it's
+            # not useful anyway since there's only one thread per process
+            _process_ctx.pop('u2net_batcher',None)
+            _process_ctx['options']['batch_size']=1 # for other models this process loads
+        else:
+            _process_ctx=dict(options)
+            _process_ctx['batch_size']=1
+            if _process_ctx['intra_threads']==0: # same as torch below
+                _process_ctx['intra_threads']=max(1,(os.cpu_count() or 1)//nProcesses)
+            CommonInit(_process_ctx)
+        _process_bg=_process_ctx['bgimg_loaded']
+
+        # don't let every process create one torch thread per core
+        if 'u2net' in _process_ctx:
+            func_u2net.torch.set_num_threads(max(1,(os.cpu_count() or 1)//nProcesses))
+    except BaseException as e:
+        _process_init_error=f"process {os.getpid()} failed to initialize, {type(e)}: {e}"
+        return
+    print(f"process {os.getpid()} running ...")
+
+def _process_worker_job(args:tuple) -> tuple[tuple,int]:
+    # returns the item's (name,size,mtime_ns), and 1 if its output file was saved else 0
+    global _process_bg
+    if _process_init_error is not None: raise RuntimeError(_process_init_error)
+    input_dir,output_dir,entry=args
+    fn=entry[0]
+    try:
+        ok,_process_bg=_ProcessDirItem(_process_ctx,_process_lck,input_dir,output_dir,fn,
+                                       _process_bg,f"process {os.getpid()}")
+    except Exception as e:
+        print(f"process {os.getpid()} exception {type(e)}: {e}")
+        ok=0
+    return entry,ok
+
+def _GetStartMethod(theCtx:dict) -> str:
+    # Fork is unsafe on macOS, CUDA can't be used in a forked child once the parent has
+    # initialized it, and MediaPipe's landmarker doesn't survive a fork because it runs
+    # its own threads. Use spawn in these cases.
+    if not sys.platform.startswith('linux'): return 'spawn'
+    if 'u2net' not in theCtx or func_u2net.UsesCUDA(): return 'spawn'
+    return 'fork'
 
-        fnout = os.path.splitext(fn)[0]+".png"
-        output_file=os.path.join(output_dir,fnout)
-        with lck:
-            print(f"thread {threading.get_native_id()}: {input_file} => {output_file} ...")
-        maskImg:Image=_GetForegroundMask(theCtx,i1)
-        bgImg=_AdjustBackgroundImage(theCtx['bgimg_loaded'],bgImg,i1.size,i1.mode)
-        if 0==_SaveOutputFile(theCtx,i1,maskImg,bgImg,output_file): nOK=nOK+1
+def _ProcessDirectoryWithPool(theCtx:dict, input_dir:str, output_dir:str, entries):
+    # entries: iterator of (name,size,mtime_ns), consumed while the workers run
+    global _process_ctx
+    import multiprocessing
 
-    with lck: 
-        print(f"thread {threading.get_native_id()} files successfully processed: {nOK}")
-        theCtx['nOK']=theCtx['nOK']+nOK
+    nProcesses=theCtx['threads']
+    mpCtx=multiprocessing.get_context(_GetStartMethod(theCtx))
+    if mpCtx.get_start_method()=='fork':
+        _process_ctx=theCtx
+        options=None
+    else:
+        options=theCtx['options']
+    print(f"starting {nProcesses} worker processes ({mpCtx.get_start_method()}) ...")
+    sys.stdout.flush() # or forked children would print whatever is still buffered
+
+    nOK:int=0
+    made=set()
+    def _jobs():
+        for entry in entries:
+            _MakeOutputSubdir(output_dir,entry[0],made)
+            yield (input_dir,output_dir,entry)
+    manifest=theCtx.get('manifest')
+    pool=mpCtx.Pool(nProcesses,initializer=_process_worker_init,initargs=(options,nProcesses))
+    try:
+        for entry,ok in pool.imap_unordered(_process_worker_job,_jobs()):
+            nOK=nOK+ok
+            if ok and manifest is not None: manifest.Record(*entry)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    theCtx['nOK']=nOK
+
+def _SkipUpToDate(theCtx:dict, manifest:Manifest, output_dir:str, entries):
+    # passes on the entries that -inc has to process, counting the others
+    theCtx['nUpToDate']=0
+    for entry in entries:
+        if manifest.IsDone(*entry,_OutputFileName(output_dir,entry[0])):
+            theCtx['nUpToDate']=theCtx['nUpToDate']+1
+        else:
+            yield entry
 
 def ProcessOneDirectory(theCtx:dict, input_dir:str, output_dir:str):
     if not os.path.isdir(output_dir): os.makedirs(output_dir, exist_ok=True)
-    items=[x for x in os.listdir(input_dir)]
-    nItems=len(items)
+    entries=_WalkDirItems(input_dir,theCtx['recursive'],theCtx['file_patterns'],output_dir)
+    if theCtx['incremental']:
+        manifest=Manifest(output_dir,_OutputSignature(theCtx))
+        theCtx['manifest']=manifest
+        entries=_SkipUpToDate(theCtx,manifest,output_dir,entries)
+    try:
+        _ProcessDirItems(theCtx,input_dir,output_dir,entries)
+    finally:
+        if 'manifest' in theCtx: theCtx.pop('manifest').Close()
 
-    nThreads=theCtx['threads']
-    if (nThreads>nItems): nThreads=nItems
-    theCtx['nOK']:int=int(0)
-    lck=threading.Lock()
-    workers = []
-    idx0:int=0
-    for i in range(nThreads):
-        idx1:int=(nItems*(i+1))//nThreads
-        wt = threading.Thread(target=_dir_worker_thread,args=[theCtx,lck,input_dir,output_dir,items,idx0,idx1])
-        wt.start()
-        workers.append(wt)
-        idx0=idx1
-
-    for wt in workers: wt.join()
+def _OutputFileName(output_dir:str,fn:str) -> str:
+    return os.path.join(output_dir,os.path.splitext(fn)[0]+".png")
+
+def _MakeOutputSubdir(output_dir:str,fn:str,made:set):
+    # output files of a recursive walk go to the same subdirectory of output_dir as
+    # their input files, made the first time a file goes there
+    sub=os.path.dirname(fn)
+    if sub!="" and sub not in made:
+        os.makedirs(os.path.join(output_dir,sub),exist_ok=True)
+        made.add(sub)
+
+def _ReportDirTotals(theCtx:dict):
     print(f"\ntotal files successfully processed: {theCtx['nOK']}")
+    if 'nUpToDate' in theCtx: print(f"files up to date, not processed: {theCtx['nUpToDate']}")
 
-def _stdin_worker_thread(q:queue.Queue, theCtx:dict, lck:threading.Lock, output_specifier:str):
-    with lck: print(f"thread {threading.get_native_id()} running ...")
-    while True:
-        work_item:tuple(int,Image)=q.get()
-        if work_item[0]==-1: # image index, -1 is used as exit signal
-            break
-        try:
-            outfn=output_specifier % work_item[0]
-            with lck: print(f"thread {threading.get_native_id()} processing img#{work_item[0]} to {outfn} ...")
-            i1:Image=work_item[1]
-            maskImg:Image=_GetForegroundMask(theCtx,i1)
-            _SaveOutputFile(theCtx,i1,maskImg,theCtx['bgimg_loaded'],outfn)
-        except Exception as e:
-            with lck: print(f"thread {threading.get_native_id()} exception {type(e)}: {e}")
-    with lck: print(f"thread {threading.get_native_id()} exiting ...")
-
-def _read_piped_input(file_number:int, outBuf:bytearray, bufLen:int) -> int :
+def _ProcessDirItems(theCtx:dict, input_dir:str, output_dir:str, entries):
+    # entries: iterator of (name,size,mtime_ns) of the files to process
+    if theCtx['backend']=='process':
+        _ProcessDirectoryWithPool(theCtx,input_dir,output_dir,entries)
+        _ReportDirTotals(theCtx)
+        return
+
+    lck=threading.Lock()
+    pl=_BuildPipeline(theCtx,lck,theCtx['threads'])
+    pl.Start()
+    made=set()
+    manifest=theCtx.get('manifest')
+    try:
+        for entry in entries: # Put waits while the pipeline is full, so we don't walk far ahead
+            fn=entry[0]
+            _MakeOutputSubdir(output_dir,fn,made)
+            input_file=os.path.join(input_dir,fn)
+            item={'name':input_file,'input_file':input_file,'output_file':_OutputFileName(output_dir,fn)}
+            if manifest is not None: item['stat']=entry
+            model=_ModelFor(theCtx,fn)
+            if model is not None: item['model']=model
+            pl.Put(item)
+    finally: # the walk or making a subdirectory can fail, let the workers finish and exit
+        pl.Finish()
+    theCtx['nOK']=pl.Completed()
+    _ReportDirTotals(theCtx)
+    _ReportPipeline(theCtx,pl)
+
+class _FrameBuffer:
+    # a preallocated buffer holding one RGB24 frame, see _FrameBufferPool
+    def __init__(self,pool,width:int,height:int):
+        self._pool=pool
+        self.data=bytearray(width*height*3)
+        self.view=memoryview(self.data)
+        self.pixels=np.frombuffer(self.data,dtype=np.uint8).reshape(height,width,3) # no copy
+
+    def Release(self):
+        self._pool.put(self)
+
+class _FrameBufferPool(queue.Queue):
+    # Frames are read from stdin into a fixed set of reusable buffers, instead of
+    # allocating and copying new bytes objects for every frame. The numpy view of a
+    # buffer goes to the model as is, the buffer is returned to the pool once the model
+    # is done with it. If all buffers are in use, reading waits, which also limits how
+    # many frames are in memory at any time.
+    def __init__(self,nBuffers:int,width:int,height:int):
+        super(_FrameBufferPool,self).__init__()
+        for i in range(nBuffers): self.put(_FrameBuffer(self,width,height))
+
+    def Acquire(self) -> _FrameBuffer:
+        return self.get()
+
+def _read_piped_input(raw_input, outBuf:memoryview, bufLen:int) -> int :
 #Most likely, OS's pipe buffer is smaller than a full image, and there's no guarantee how
-#many bytes are available to read at any given time, thus this complicated read procedure.
-#Basically, this is like reading a TCP/IP socket.
+#many bytes are available to read at any given time, so keep reading until we have a full
+#image. Basically, this is like reading a TCP/IP socket.
 #On Windows, it seems I could read at most 32K bytes at a time.
+#Bytes are read directly into outBuf, with no intermediate copies. A read blocks until some
+#data arrives, and reading 0 bytes means end of input, so we return at once in that case.
     bytesAlreadyRead:int=0 #how many bytes were already read
-    consecutive_errors:int=0
-    while True:
-        byteBuf=os.read(file_number,bufLen-bytesAlreadyRead)
-        if (len(byteBuf)>0): #we read some bytes
-            #print(f"read {len(byteBuf)} bytes\n")
-            j:int=bytesAlreadyRead+len(byteBuf) #copy what we just read into outBuf[]
-            outBuf[bytesAlreadyRead:j]=byteBuf
-            bytesAlreadyRead=j
-            if (bytesAlreadyRead==bufLen): #yes, we got all the bytes we need
-                break
-            consecutive_errors=0 #reset error counter
-        else: #read failed
-            consecutive_errors+=1
-            if consecutive_errors==6:
-                break
-            time.sleep(0.5) #wait for more data to get into pipe
+    while bytesAlreadyRead<bufLen:
+        n=raw_input.readinto(outBuf[bytesAlreadyRead:bufLen])
+        if n is None: #non-blocking input with no data available, wait for some
+            _wait_readable(raw_input)
+        elif n==0: #end of input
+            break
+        else:
+            bytesAlreadyRead=bytesAlreadyRead+n
     return bytesAlreadyRead
 
+def _wait_readable(raw_input):
+    if sys.platform=='win32': # select() only works with sockets on Windows
+        time.sleep(0.001)
+    else:
+        import select
+        select.select([raw_input],[],[])
+
+def _stdin_reader_thread(raw_input, frames:_FrameBufferPool, q:queue.Queue, bytesPerImage:int,
+                         lck:threading.Lock):
+    # reads frames ahead of processing, q holds frames read but not yet taken, None ends it
+    img_index:int=0
+    while True:
+        frame=frames.Acquire()
+        bytesRead:int=_read_piped_input(raw_input,frame.view,bytesPerImage)
+        if (bytesRead!=bytesPerImage):
+            frame.Release()
+            with lck:
+                if bytesRead>0:
+                    print(f"incomplete image at index {img_index}, {bytesRead} of {bytesPerImage} bytes, ignored")
+                print(f"read stopped at image index {img_index}")
+            q.put(None)
+            break
+        q.put(frame)
+        img_index=img_index+1
+
 def ReadStdin(theCtx:dict,image_width:int,image_height:int,output_specifier:str)->int:
     """Process a sequence of RGB24 images from stdin. This is intended to be used with another program, such
     as FFMPEG, that outputs RGB24 pixel data to stdout, which is piped into the stdin of this program.
@@ -201,6 +657,8 @@ def ReadStdin(theCtx:dict,image_width:int,image_height:int,output_specifier:str)
       output_specifier: printf-style specifier for output filenames, for example if abc%03u.png, then
         output files will be named abc000.png, abc001.png, abc002.png, etc.
         Output files will be saved in PNG format regardless of the extension specified.
+        With the "-of raw" option, this is a file or named pipe to write all frames to, in
+        input order, or "-" for stdout.
 
     Example usage with FFMPEG:
 
@@ -216,29 +674,129 @@ def ReadStdin(theCtx:dict,image_width:int,image_height:int,output_specifier:str)
     theCtx['bgimg_loaded']=_AdjustBackgroundImage(theCtx['bgimg_loaded'],theCtx['bgimg_loaded'],
                                                   (image_width,image_height),"RGB")
 
-    output_dir=os.path.dirname(os.path.abspath(output_specifier))
-    if not os.path.isdir(output_dir): os.makedirs(output_dir, exist_ok=True)
+    if 'mp_face_landmarkers' in theCtx and theCtx['face_tracking']>0:
+        theCtx['face_tracker']=func_mp.FaceTracker(theCtx['face_tracking'])
+
+    keyframes=None
+    if theCtx['keyframe_threshold']>0 or theCtx['mask_smoothing']>0:
+        import func_temporal
+        keyframes=func_temporal.KeyframeSelector(image_width,image_height,theCtx['keyframe_threshold'],
+                                                 theCtx['keyframe_interval'],theCtx['mask_smoothing'])
+        theCtx['keyframes']=keyframes
 
-    nThreads=theCtx['threads']
-    q=queue.Queue(nThreads+1)
     lck=threading.Lock() # use this lock when printing to console
-    workers = []
-    for i in range(nThreads):
-        wt = threading.Thread(target=_stdin_worker_thread,args=[q,theCtx,lck,output_specifier])
-        wt.start()
-        workers.append(wt)
+    writer:ReorderBuffer=None
+    if theCtx['output_format']=='raw':
+        pixFmt,bpp=_RAW_FORMATS[theCtx['mask_usage']]
+        print(f"writing raw {pixFmt} frames to {'stdout' if output_specifier=='-' else output_specifier}")
+        writer,rawFile=_OpenRawOutput(theCtx,output_specifier,image_width*image_height*bpp)
+        theCtx['frame_writer']=writer
+    else:
+        try: # formatted for every frame, find out now if that can't work
+            output_specifier % 0
+        except (TypeError,ValueError) as e:
+            print(f"output_specifier {output_specifier} can't be formatted with an image index, {e}; "
+                  f"it needs one printf-style integer field, for example out%03u.png")
+            return -1
+        output_dir=os.path.dirname(os.path.abspath(output_specifier))
+        if not os.path.isdir(output_dir): os.makedirs(output_dir, exist_ok=True)
+
+    def _on_drop(item:dict):
+        if 'frame' in item: item.pop('frame').Release()
+        # a frame that failed in the pipeline must still take its turn in the output
+        if writer is not None: writer.Put(item['index'],None)
+    pl=_BuildPipeline(theCtx,lck,theCtx['threads'],_on_drop)
+    pl.Start()
 
+    # enough buffers for every frame read ahead, plus every frame that can be in
+    # the pipeline before the model is done with it
+    readAhead:int=theCtx['read_ahead']
+    nInfer=theCtx['threads'] if theCtx['pipeline'] is None else sum(theCtx['pipeline'][:2])
+    frames=_FrameBufferPool(3*nInfer+readAhead+2,image_width,image_height)
+    raw_input=io.FileIO(sys.stdin.fileno(),'rb',closefd=False) # unbuffered, reads go straight into our buffers
     bytesPerImage:int=image_width*image_height*int(3)
-    fullBuf=bytearray(bytesPerImage)
+    q=queue.Queue(readAhead)
+    # daemon, so that it doesn't keep us waiting on stdin if we stop early
+    rt=threading.Thread(target=_stdin_reader_thread,args=[raw_input,frames,q,bytesPerImage,lck],daemon=True)
+    rt.start()
+
     img_index:int=0
-    while True:
-        bytesRead:int=_read_piped_input(sys.stdin.fileno(),fullBuf,bytesPerImage)
-        if (bytesRead!=bytesPerImage):
-            with lck: print(f"read stopped at image index {img_index}")
-            break
-        img=Image.frombytes("RGB",(image_width,image_height),bytes(fullBuf),"raw")
-        q.put([img_index,img])
-        img_index=img_index+1
-    
-    for i in range(len(workers)): q.put([-1,''])
-    for wt in workers: wt.join()
+    try:
+        while True:
+            frame=q.get()
+            if frame is None: break
+            # PIL keeps RGB images in its own 4-bytes-per-pixel layout, so this is the only copy
+            img=Image.frombuffer("RGB",(image_width,image_height),frame.data,"raw","RGB",0,1)
+            if writer is None:
+                item={'name':f"img#{img_index}",'img':img,'frame':frame,'output_file':output_specifier % img_index}
+            else:
+                if writer.error is not None: # most likely, whoever reads our output has quit
+                    frame.Release()
+                    with lck: print(f"output error: {writer.error}, stopped at image index {img_index}")
+                    break
+                item={'name':f"img#{img_index}",'index':img_index,'img':img,'frame':frame,'output_file':output_specifier}
+            if keyframes is not None:
+                item['mask_future']=keyframes.Next(frame.pixels,functools.partial(_GetForegroundMask,theCtx,img,frame.pixels))
+            pl.Put(item)
+            img_index=img_index+1
+    finally: # whatever happens here, let the workers finish and exit
+        pl.Finish()
+    if writer is not None:
+        _CloseRawOutput(theCtx,writer,rawFile)
+        print(f"frames written: {writer.nextIndex}")
+    _ReportPipeline(theCtx,pl)
+
+# Options that trade mask accuracy for speed, and the values the reference masks of
+# CompareMasks are made with.
+_REFERENCE_OPTIONS={'engine':'torch', 'precision':'fp32', 'channels_last':False, 'optimize':'none',
+                    'inference_size':320, 'fit':'stretch', 'refine_tile':0}
+
+def _TimedMask(theCtx:dict,i1:Image) -> tuple[np.ndarray,float]:
+    # returns mask as a numpy array, and milliseconds it took
+    t0=time.perf_counter()
+    mask=_GetForegroundMask(theCtx,i1)
+    return np.asarray(mask,dtype=np.int16),1000*(time.perf_counter()-t0)
+
+def CompareMasks(theCtx:dict,input_dir:str) -> int:
+    """Make masks of the images in input_dir with the current options, and with the reference
+    options (torch, float32, default memory layout, not quantized or optimized, 320x320
+    stretched, not refined), then print how far apart they are, and how long
+    each took. Masks are compared by mean and max absolute difference (0-255), and by IoU of
+    their foregrounds (mask value 128 or more)."""
+    refCtx=dict(theCtx['options'])
+    refCtx.update(_REFERENCE_OPTIONS)
+    changed=[f"{k}={theCtx[k]}" for k in _REFERENCE_OPTIONS if theCtx[k]!=refCtx[k]]
+    if len(changed)==0: print("note: current options are the same as the reference options")
+    CommonInit(refCtx)
+
+    items=_ListDirItems(theCtx,input_dir)
+    diffs,maxDiff,ious,tRef,tTest=[],0,[],0.0,0.0
+    warm=False
+    for fn in items:
+        i1=_LoadInputImage(os.path.join(input_dir,fn))
+        if i1 is None: continue
+        if not warm: # first calls are slow, don't count them
+            _GetForegroundMask(refCtx,i1)
+            _GetForegroundMask(theCtx,i1)
+            warm=True
+        mRef,ms1=_TimedMask(refCtx,i1)
+        mTest,ms2=_TimedMask(theCtx,i1)
+        d=np.abs(mTest-mRef)
+        fgRef,fgTest=mRef>=128,mTest>=128
+        union=np.count_nonzero(fgRef|fgTest)
+        iou=np.count_nonzero(fgRef&fgTest)/union if union>0 else 1.0
+        diffs.append(d.mean())
+        maxDiff=max(maxDiff,int(d.max()))
+        ious.append(iou)
+        tRef,tTest=tRef+ms1,tTest+ms2
+        print(f"{fn}: mean diff {d.mean():.3f}, max diff {d.max()}, IoU {iou:.4f}, "
+              f"{ms1:.1f} ms reference, {ms2:.1f} ms current")
+
+    n=len(diffs)
+    if n==0:
+        print("no images compared")
+        return -1
+    print(f"\n{n} images, current options: {' '.join(changed) if changed else '(reference)'}")
+    print(f"mean diff {sum(diffs)/n:.3f}, max diff {maxDiff}, mean IoU {sum(ious)/n:.4f}, min IoU {min(ious):.4f}")
+    print(f"average time per image: {tRef/n:.1f} ms reference, {tTest/n:.1f} ms current, speedup {tRef/max(tTest,1e-6):.2f}x")
+    return 0
@@ -1,2 +1,3 @@
 from .u2net import U2NET
 from .u2net import U2NETP
+from .u2net import fuse_conv_bn
@@ -17,6 +17,18 @@ class REBNCONV(nn.Module):
 
         return xout
 
+    def fuse(self):
+        # for inference only: fold BatchNorm into the conv's weights and bias, in eval mode
+        # BN is just a per-channel scale and shift of the conv output
+        self.conv_s1 = torch.nn.utils.fusion.fuse_conv_bn_eval(self.conv_s1,self.bn_s1)
+        self.bn_s1 = nn.Identity()
+
+def fuse_conv_bn(net):
+    ## fold BatchNorm into conv of every REBNCONV in net, which must be in eval mode
+    for m in net.modules():
+        if isinstance(m,REBNCONV) and not isinstance(m.bn_s1,nn.Identity): m.fuse()
+    return net
+
 ## upsample tensor 'src' to have the same spatial size with tensor 'tar'
 def _upsample_like(src,tar):
 
@@ -86,21 +98,32 @@ class RSU7(nn.Module):#UNet07DRES(nn.Module):
         hx7 = self.rebnconv7(hx6)
 
         hx6d =  self.rebnconv6d(torch.cat((hx7,hx6),1))
+        del hx7, hx6
         hx6dup = _upsample_like(hx6d,hx5)
+        del hx6d
 
         hx5d =  self.rebnconv5d(torch.cat((hx6dup,hx5),1))
+        del hx6dup, hx5
         hx5dup = _upsample_like(hx5d,hx4)
+        del hx5d
 
         hx4d = self.rebnconv4d(torch.cat((hx5dup,hx4),1))
+        del hx5dup, hx4
         hx4dup = _upsample_like(hx4d,hx3)
+        del hx4d
 
         hx3d = self.rebnconv3d(torch.cat((hx4dup,hx3),1))
+        del hx4dup, hx3
         hx3dup = _upsample_like(hx3d,hx2)
+        del hx3d
 
         hx2d = self.rebnconv2d(torch.cat((hx3dup,hx2),1))
+        del hx3dup, hx2
         hx2dup = _upsample_like(hx2d,hx1)
+        del hx2d
 
         hx1d = self.rebnconv1d(torch.cat((hx2dup,hx1),1))
+        del hx2dup, hx1
 
         return hx1d + hxin
 
@@ -158,18 +181,27 @@ class RSU6(nn.Module):#UNet06DRES(nn.Module):
 
 
         hx5d =  self.rebnconv5d(torch.cat((hx6,hx5),1))
+        del hx6, hx5
         hx5dup = _upsample_like(hx5d,hx4)
+        del hx5d
 
         hx4d = self.rebnconv4d(torch.cat((hx5dup,hx4),1))
+        del hx5dup, hx4
         hx4dup = _upsample_like(hx4d,hx3)
+        del hx4d
 
         hx3d = self.rebnconv3d(torch.cat((hx4dup,hx3),1))
+        del hx4dup, hx3
         hx3dup = _upsample_like(hx3d,hx2)
+        del hx3d
 
         hx2d = self.rebnconv2d(torch.cat((hx3dup,hx2),1))
+        del hx3dup, hx2
         hx2dup = _upsample_like(hx2d,hx1)
+        del hx2d
 
         hx1d = self.rebnconv1d(torch.cat((hx2dup,hx1),1))
+        del hx2dup, hx1
 
         return hx1d + hxin
 
@@ -219,15 +251,22 @@ class RSU5(nn.Module):#UNet05DRES(nn.Module):
         hx5 = self.rebnconv5(hx4)
 
         hx4d = self.rebnconv4d(torch.cat((hx5,hx4),1))
+        del hx5, hx4
         hx4dup = _upsample_like(hx4d,hx3)
+        del hx4d
 
         hx3d = self.rebnconv3d(torch.cat((hx4dup,hx3),1))
+        del hx4dup, hx3
         hx3dup = _upsample_like(hx3d,hx2)
+        del hx3d
 
         hx2d = self.rebnconv2d(torch.cat((hx3dup,hx2),1))
+        del hx3dup, hx2
         hx2dup = _upsample_like(hx2d,hx1)
+        del hx2d
 
         hx1d = self.rebnconv1d(torch.cat((hx2dup,hx1),1))
+        del hx2dup, hx1
 
         return hx1d + hxin
 
@@ -270,12 +309,17 @@ class RSU4(nn.Module):#UNet04DRES(nn.Module):
         hx4 = self.rebnconv4(hx3)
 
         hx3d = self.rebnconv3d(torch.cat((hx4,hx3),1))
+        del hx4, hx3
         hx3dup = _upsample_like(hx3d,hx2)
+        del hx3d
 
         hx2d = self.rebnconv2d(torch.cat((hx3dup,hx2),1))
+        del hx3dup, hx2
         hx2dup = _upsample_like(hx2d,hx1)
+        del hx2d
 
         hx1d = self.rebnconv1d(torch.cat((hx2dup,hx1),1))
+        del hx2dup, hx1
 
         return hx1d + hxin
 
@@ -310,8 +354,11 @@ class RSU4F(nn.Module):#UNet04FRES(nn.Module):
         hx4 = self.rebnconv4(hx3)
 
         hx3d = self.rebnconv3d(torch.cat((hx4,hx3),1))
+        del hx4, hx3
         hx2d = self.rebnconv2d(torch.cat((hx3d,hx2),1))
+        del hx3d, hx2
         hx1d = self.rebnconv1d(torch.cat((hx2d,hx1),1))
+        del hx2d, hx1
 
         return hx1d + hxin
 
@@ -385,36 +432,47 @@ class U2NET(nn.Module):
 
         #-------------------- decoder --------------------
         hx5d = self.stage5d(torch.cat((hx6up,hx5),1))
+        del hx6up, hx5
         hx5dup = _upsample_like(hx5d,hx4)
 
         hx4d = self.stage4d(torch.cat((hx5dup,hx4),1))
+        del hx5dup, hx4
         hx4dup = _upsample_like(hx4d,hx3)
 
         hx3d = self.stage3d(torch.cat((hx4dup,hx3),1))
+        del hx4dup, hx3
         hx3dup = _upsample_like(hx3d,hx2)
 
         hx2d = self.stage2d(torch.cat((hx3dup,hx2),1))
+        del hx3dup, hx2
         hx2dup = _upsample_like(hx2d,hx1)
 
         hx1d = self.stage1d(torch.cat((hx2dup,hx1),1))
+        del hx2dup, hx1
 
 
         #side output
         d1 = self.side1(hx1d)
+        del hx1d
 
         d2 = self.side2(hx2d)
+        del hx2d
         d2 = _upsample_like(d2,d1)
 
         d3 = self.side3(hx3d)
+        del hx3d
         d3 = _upsample_like(d3,d1)
 
         d4 = self.side4(hx4d)
+        del hx4d
         d4 = _upsample_like(d4,d1)
 
         d5 = self.side5(hx5d)
+        del hx5d
         d5 = _upsample_like(d5,d1)
 
         d6 = self.side6(hx6)
+        del hx6
         d6 = _upsample_like(d6,d1)
 
         d0 = self.outconv(torch.cat((d1,d2,d3,d4,d5,d6),1))
@@ -491,36 +549,47 @@ class U2NETP(nn.Module):
 
         #decoder
         hx5d = self.stage5d(torch.cat((hx6up,hx5),1))
+        del hx6up, hx5
         hx5dup = _upsample_like(hx5d,hx4)
 
         hx4d = self.stage4d(torch.cat((hx5dup,hx4),1))
+        del hx5dup, hx4
         hx4dup = _upsample_like(hx4d,hx3)
 
         hx3d = self.stage3d(torch.cat((hx4dup,hx3),1))
+        del hx4dup, hx3
         hx3dup = _upsample_like(hx3d,hx2)
 
         hx2d = self.stage2d(torch.cat((hx3dup,hx2),1))
+        del hx3dup, hx2
         hx2dup = _upsample_like(hx2d,hx1)
 
         hx1d = self.stage1d(torch.cat((hx2dup,hx1),1))
+        del hx2dup, hx1
 
 
         #side output
         d1 = self.side1(hx1d)
+        del hx1d
 
         d2 = self.side2(hx2d)
+        del hx2d
         d2 = _upsample_like(d2,d1)
 
         d3 = self.side3(hx3d)
+        del hx3d
         d3 = _upsample_like(d3,d1)
 
         d4 = self.side4(hx4d)
+        del hx4d
         d4 = _upsample_like(d4,d1)
 
         d5 = self.side5(hx5d)
+        del hx5d
         d5 = _upsample_like(d5,d1)
 
         d6 = self.side6(hx6)
+        del hx6
         d6 = _upsample_like(d6,d1)
 
         d0 = self.outconv(torch.cat((d1,d2,d3,d4,d5,d6),1))